@@ -0,0 +1,34 @@
+"""
+Micro benchmarks of the ledger, routing table, message & crypto hot paths.
+
+Run them (from the repository root) with:
+
+    python3 -m benchmarks [--sizes 1000,10000] [--save FILE] [--compare FILE]
+
+Each benchmark reports the best time per operation (in seconds) over a few
+repeats. --save writes these as a JSON baseline, --compare checks them
+against one and exits with status 1 if anything got slower than the
+threshold allows.
+"""
+
+import timeit
+
+# name => function(sizes) that yields (benchmark name, seconds per op)
+SUITES = {}
+
+
+def suite(func):
+    """
+    A decorator to register a suite of benchmarks.
+    """
+
+    SUITES[func.__name__] = func
+    return func
+
+
+def measure(func, number=100, repeat=3):
+    """
+    Best time per call of func.
+    """
+
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
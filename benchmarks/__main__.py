@@ -0,0 +1,80 @@
+import argparse
+import json
+import platform
+import sys
+
+from benchmarks import SUITES
+
+# Importing these registers their suites
+from benchmarks import ledger, routing, messages  # noqa
+
+
+def run(names, sizes):
+    results = {}
+
+    for name in names:
+        for benchmark, seconds in SUITES[name](sizes):
+            print("%-40s %12.3f us %14.1f ops/s" % (benchmark, seconds * 10**6, 1 / seconds))
+            results[benchmark] = seconds
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """
+    Benchmarks that are more than threshold (a fraction) slower than baseline.
+    """
+
+    regressions = []
+
+    for benchmark, seconds in sorted(results.items()):
+        if benchmark not in baseline:
+            continue
+
+        ratio = seconds / baseline[benchmark]
+        print("%-40s %8.2fx" % (benchmark, ratio))
+
+        if ratio > 1 + threshold:
+            regressions.append((benchmark, ratio))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python3 -m benchmarks')
+    parser.add_argument('suites', nargs='*', help='suites to run: %s (default: all)' % ', '.join(sorted(SUITES)))
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000', help='comma separated ledger & routing table sizes')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results against a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown wrt the baseline (default: 0.2)')
+
+    args = parser.parse_args()
+
+    unknown = set(args.suites) - set(SUITES)
+    if unknown:
+        parser.error('unknown suites: %s' % ', '.join(sorted(unknown)))
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    results = run(args.suites or sorted(SUITES), sizes)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(), 'results': results}, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+        print()
+        regressions = compare(results, baseline, args.threshold)
+
+        for benchmark, ratio in regressions:
+            print("REGRESSION: %s is %.2fx slower" % (benchmark, ratio))
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
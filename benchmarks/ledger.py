@@ -0,0 +1,68 @@
+import itertools
+import random
+
+from transaction import Ledger, Transaction
+
+from benchmarks import suite, measure
+
+ACCOUNTS = 100
+
+
+def filled_ledger(size, rng):
+    """
+    A ledger of size unspent transactions to ACCOUNTS accounts.
+    """
+
+    ledger = Ledger(0)
+    ledger.record = []
+
+    for i in range(size):
+        tx = Transaction(None, rng.randrange(ACCOUNTS), None, rng.randint(1, 100), None)
+
+        # Creating these back to back could repeat time based ids
+        tx.id = i
+        ledger.record.append(tx)
+
+    return ledger
+
+
+@suite
+def ledger(sizes):
+    for size in sizes:
+        # Each benchmark gets a ledger of its own (add_tx grows it)
+        rng = random.Random(size)
+        ledger = filled_ledger(size, rng)
+
+        ids = itertools.count(size)
+
+        def add_tx():
+            tx = Transaction(None, rng.randrange(ACCOUNTS), None, 1, None)
+            tx.id = next(ids)
+            ledger.add_tx(tx)
+
+        yield 'ledger.add_tx[%d]' % size, measure(add_tx, number=20)
+
+        rng = random.Random(size)
+        ledger = filled_ledger(size, rng)
+
+        def gen_trans():
+            ledger.gen_trans(rng.randrange(ACCOUNTS), 1, 2, 50)
+
+        yield 'ledger.gen_trans[%d]' % size, measure(gen_trans)
+
+        rng = random.Random(size)
+        ledger = filled_ledger(size, rng)
+
+        # Transactions to verify, made up front so only verify_trans is timed
+        pending = []
+        while len(pending) < 100:
+            ok, txs = ledger.gen_trans(rng.randrange(ACCOUNTS), 1, 2, 50)
+            if ok:
+                pending.append(txs)
+
+        pending = itertools.cycle(pending)
+
+        def verify_trans():
+            ledger.verify_trans(next(pending))
+
+        yield 'ledger.verify_trans[%d]' % size, measure(verify_trans, number=20)
@@ -0,0 +1,41 @@
+import pickle
+
+from rpc_protocol import batch, unbatch
+from transaction import Transaction
+from utils import random_id, gen_pub_pvt, sign_msg, verify_msg
+
+from benchmarks import suite, measure
+
+
+@suite
+def messages(sizes):
+    genesis = Transaction(None, random_id(), None, 100, None)
+    txs = [
+        Transaction(genesis.receiver, random_id(), random_id(), 40, [genesis]),
+        Transaction(genesis.receiver, genesis.receiver, random_id(), 60, [genesis]),
+    ]
+
+    # What a commit_tx request looks like on the wire
+    request = ('request', random_id(), 'commit_tx', (random_id(), txs, 'ab' * 64, 'cd' * 64), {})
+    encoded = pickle.dumps(request, protocol=0)
+
+    yield 'messages.encode', measure(lambda: pickle.dumps(request, protocol=0), number=1000)
+    yield 'messages.decode', measure(lambda: pickle.loads(encoded), number=1000)
+
+    ping = pickle.dumps(('request', random_id(), 'ping', (random_id(), ), {}), protocol=0)
+    datagram = batch([ping] * 10)
+
+    yield 'messages.batch[10]', measure(lambda: batch([ping] * 10), number=1000)
+    yield 'messages.unbatch[10]', measure(lambda: list(unbatch(datagram)), number=1000)
+
+
+@suite
+def crypto(sizes):
+    pub_key, pvt_key = gen_pub_pvt()
+
+    msg = repr([Transaction(None, random_id(), None, 100, None)])
+    signature = sign_msg(pvt_key, msg)
+
+    yield 'crypto.gen_pub_pvt', measure(gen_pub_pvt, number=10)
+    yield 'crypto.sign_msg', measure(lambda: sign_msg(pvt_key, msg), number=10)
+    yield 'crypto.verify_msg', measure(lambda: verify_msg(pub_key, msg, signature), number=10)
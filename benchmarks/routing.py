@@ -0,0 +1,44 @@
+import random
+
+from routing_table import RoutingTable
+
+from benchmarks import suite, measure
+
+# Peers are spread over this many buckets (the ones further down are
+# too small to fill, bucket i only has room for 2 ** (159 - i) ids)
+BUCKETS = 128
+
+
+def id_in_bucket(table, index, rng):
+    """
+    A random identifier whose distance from the table's own puts it into
+    bucket index.
+    """
+
+    bits = 160 - index
+    return table.node_identifier ^ rng.randrange(2 ** (bits - 1), 2 ** bits)
+
+
+@suite
+def routing(sizes):
+    for size in sizes:
+        rng = random.Random(size)
+        table = RoutingTable(rng.getrandbits(160))
+
+        # Random ids would almost all land in the first few buckets, so
+        # fill the buckets one after another instead (k peers each), the
+        # peers beyond BUCKETS * k end up in replacement caches
+        for i in range(size):
+            table.update_peer(id_in_bucket(table, (i // table.k) % BUCKETS, rng), ('10.0.0.1', i))
+
+        filled = min(BUCKETS, max(1, size // table.k))
+
+        def update_peer():
+            table.update_peer(id_in_bucket(table, rng.randrange(filled), rng), ('10.0.0.2', 0))
+
+        yield 'routing.update_peer[%d]' % size, measure(update_peer, number=1000)
+
+        def find_closest_peers():
+            table.find_closest_peers(rng.getrandbits(160))
+
+        yield 'routing.find_closest_peers[%d]' % size, measure(find_closest_peers, number=1000)
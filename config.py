@@ -12,3 +12,196 @@ PORT = 9000
 
 # The default log level
 LOGLEVEL = logging.INFO
+
+# Log levels of each subsystem's logger (all of them are children of 'node')
+LOG_LEVELS = {
+    'node.rpc': logging.INFO,
+    'node.dht': logging.INFO,
+    'node.ledger': logging.INFO,
+}
+
+# Only this fraction of per message log lines (requests, replies, handlers)
+# are written, with payloads cut down to about LOG_PAYLOAD_LIMIT characters
+LOG_SAMPLE_RATE = 0.05
+LOG_PAYLOAD_LIMIT = 200
+
+# How broadcasts propagate between nodes:
+#   "flood" - every hop re-sends the full payload to all its peers
+#   "inv"   - every hop announces the message id, peers fetch what they miss
+BROADCAST_MODE = "inv"
+
+# Number of recent broadcast payloads kept around to answer getdata requests
+BROADCAST_CACHE_SIZE = 1024
+
+# A getdata that isn't answered within the reply timeout is sent again
+# (to the next peer that announced the message) atmost this many times
+GETDATA_RETRIES = 3
+
+# Number of message ids remembered per peer (the per-peer "seen" filter)
+SEEN_FILTER_SIZE = 4096
+
+# Pack small outgoing messages headed to the same peer into one datagram
+# (flushed at the end of every event loop tick or at DATAGRAM_MTU bytes)
+COALESCE_DATAGRAMS = True
+DATAGRAM_MTU = 1400
+
+# Coroutine @rpc handlers are run by a bounded dispatcher:
+# atmost DISPATCH_QUEUE_SIZE of them may be queued or running at once,
+# further requests get a "busy" reply (and broadcasts are dropped)
+DISPATCH_QUEUE_SIZE = 256
+
+# How many handlers of a single procedure may run concurrently
+DISPATCH_CONCURRENCY = 8
+DISPATCH_LIMITS = {
+    'commit_tx': 4,
+    'get_ledger': 2,
+    'get_ledger_range': 4,
+}
+
+# Inbound messages are queued into priority lanes and lane 0 is always
+# drained first. Replies (and busy / error answers) are always in lane 0.
+PRIORITY_LANES = {
+    # Liveness & routing
+    'ping': 0,
+    'find_node': 0,
+    'find_value': 0,
+    'store': 0,
+    'store_many': 0,
+    'find_values': 0,
+
+    # Commit traffic
+    'send_amount': 1,
+    'become_receiver': 1,
+    'become_witness': 1,
+    'commit_tx': 1,
+    'abort_tx': 1,
+    'add_tx_to_ledger': 1,
+    'inv': 1,
+    'getdata': 1,
+
+    # Light nodes fetch the inputs of a transaction while committing it
+    'get_transactions': 1,
+
+    # Sync & bulk
+    'get_ledger': 2,
+    'get_ledger_info': 2,
+    'get_ledger_range': 2,
+    'get_account': 2,
+    'print_ledger': 2,
+    'get_stats': 2,
+    'profile': 2,
+}
+DEFAULT_PRIORITY_LANE = 2
+
+# Number of inbound messages handled per event loop tick, of which
+# atleast INBOUND_MIN_SHARE go to each lane after the first (if it has
+# that many queued.) Each lane holds atmost INBOUND_LANE_SIZE messages
+# and drops its oldest when it's full.
+INBOUND_BUDGET = 64
+INBOUND_MIN_SHARE = 4
+INBOUND_LANE_SIZE = 4096
+
+# Token bucket limit on non-reply messages from a single source address:
+# RATE_LIMIT messages per second on average, bursts of RATE_LIMIT_BURST
+RATE_LIMIT = 200
+RATE_LIMIT_BURST = 400
+
+# Buckets that haven't seen a lookup for this long (in seconds)
+# are refreshed by looking up a random id that falls into them
+BUCKET_REFRESH_INTERVAL = 3600
+
+# Number of pings that ping_all_neighbors keeps in flight
+PING_CONCURRENCY = 16
+
+# Values stored in the DHT expire after this many seconds, unless republished
+DHT_TTL = 86400
+
+# Stored values are pushed to the k closest nodes this often (in seconds)
+REPUBLISH_INTERVAL = 3600
+
+# Replicas of values published by others are evicted (least recently used
+# first) once the stored values take up more than this many bytes
+DHT_MAX_BYTES = 64 * 2**20
+
+# Values found by a lookup are cached at the closest node on the lookup path
+# that didn't have them. The cached copy lives for PATH_CACHE_TTL seconds,
+# halved for every bit of distance between it and the node we found it at.
+PATH_CACHE_TTL = 3600
+
+# put_many/get_many share one lookup between keys that agree on this many
+# leading bits (i.e. are likely to be stored at the same k nodes)
+DHT_BATCH_PREFIX_BITS = 8
+
+# Nodes snapshot their routing table & DHT storage into this directory
+# every SNAPSHOT_INTERVAL seconds, and restore it when restarted
+STATE_DIR = "state"
+SNAPSHOT_INTERVAL = 30
+
+# A joining node downloads disjoint ranges of the ledger from this many
+# of its closest peers in parallel
+LEDGER_SYNC_PEERS = 4
+
+# Nodes spawned by start_network join via (atmost) this many earlier nodes
+BOOTSTRAP_NODES = 3
+
+# Light nodes only keep transactions they're involved in (see LightLedger)
+# and ask this many peers for proof of inputs they haven't seen
+LIGHT_NODE = False
+LIGHT_PROOF_PEERS = 3
+
+# In a sharded ledger, each account's transactions are only kept (and
+# validated) by the SHARD_REPLICAS nodes closest to shard_key(account)
+SHARDED_LEDGER = False
+SHARD_REPLICAS = 20
+
+# Spent transactions older than the last checkpoint are moved out of memory
+# into ARCHIVE_DIR. Checkpoints are aligned to multiples of
+# COMPACTION_INTERVAL (seconds) so all nodes archive the same transactions.
+ARCHIVE_DIR = "archive"
+COMPACTION_INTERVAL = 600
+
+# 2PC state changes are logged to WAL_DIR before they're acknowledged,
+# records within WAL_GROUP_COMMIT_DELAY seconds share a single fsync
+WAL_DIR = "wal"
+WAL_GROUP_COMMIT_DELAY = 0.002
+
+# A receiver or witness restarted in the middle of a 2PC (its log has the
+# prepare, but no commit or abort) waits this many seconds for the outcome
+PREPARE_TIMEOUT = 30
+
+# How many committed transactions can still be rolled back by abort_tx
+UNDO_LOG_SIZE = 1024
+
+# Every STATS_INTERVAL seconds a node writes its stats to LOG_DIR, as
+# Prometheus text ("prom") or JSON ("json"); None turns this off
+STATS_FORMAT = None
+STATS_INTERVAL = 10
+
+# Callbacks (and message handlers) slower than this many seconds are
+# reported, the event loop's lag is measured every LOOP_LAG_INTERVAL
+# seconds while monitoring is on (see profiling.py)
+SLOW_CALLBACK_THRESHOLD = 0.1
+LOOP_LAG_INTERVAL = 0.5
+
+# Profiles list the top PROFILE_TOP entries, tracemalloc keeps
+# PROFILE_FRAMES frames per allocation
+PROFILE_TOP = 25
+PROFILE_FRAMES = 10
+PROFILE_SLOW_EVENTS = 1000
+
+# Headless launches (start_network.py --headless, start_fleet.py) spread
+# joins randomly over JOIN_STAGGER seconds, so that the bootstrappers
+# aren't all hit at once, and give up on nodes that aren't ready within
+# READY_TIMEOUT seconds
+JOIN_STAGGER = 2
+READY_TIMEOUT = 60
+
+# A node touches LOG_DIR/READY_FILE % (ip, port) once it has joined
+READY_FILE = "%s_%d.ready"
+
+# start_fleet.py joins atmost this many nodes at once in each process
+FLEET_JOIN_CONCURRENCY = 32
+
+# Each node's identifier & key pair is kept in KEYSTORE_DIR, so that a
+# restarted node is the same account (see keystore.py)
+KEYSTORE_DIR = "keys"
@@ -1,15 +1,27 @@
 import asyncio
 import logging
+import os
 import socket
 import pickle
+import random
 
+from collections import OrderedDict, defaultdict
+
+import config
+
+from metrics import COUNT_BUCKETS
 from routing_table import RoutingTable
-from rpc_protocol import DatagramRPCProtocol, rpc
+from rpc_protocol import DatagramRPCProtocol, RPCBusy, rpc
+from storage import Storage
+from tracing import MessageLog
+
+from utils import sha1_int, random_id, bounded
 
-from utils import sha1_int, random_id
 
+logger = logging.getLogger('node.dht')
 
-logger = logging.getLogger('node')
+# Per message logs, sampled
+trace = MessageLog(logger)
 
 
 class KademliaNode(DatagramRPCProtocol):
@@ -30,40 +42,70 @@ class KademliaNode(DatagramRPCProtocol):
         self.k = k
         self.alpha = alpha
 
-        # Each node has their own dictionary
-        self.storage = {}
+        # Each node has their own (bounded, expiring) dictionary
+        self.storage = Storage(
+            clock=lambda: asyncio.get_event_loop().time(),
+            max_bytes=config.DHT_MAX_BYTES
+        )
 
         # The k-bucket based kademlia routing table
         self.routing_table = RoutingTable(self.identifier, k=self.k)
 
+        # Identifiers of peers we're currently checking the liveness of
+        self.pinging = set()
+
+        # "flood" or "inv" (announce ids, let peers fetch missing payloads)
+        self.broadcast_mode = config.BROADCAST_MODE
+
+        # Recent broadcast payloads, used to answer getdata requests
+        # message_identifier => (procedure_name, args)
+        self.broadcast_payloads = OrderedDict()
+
+        # Message ids that each peer is known to have seen
+        # peer => OrderedDict(message_identifier => None)
+        self.seen_filters = defaultdict(OrderedDict)
+
+        # Message ids we've asked someone for
+        # message_identifier => time of the getdata request
+        self.requested_broadcasts = OrderedDict()
+
+        # Peers that announced a message we haven't got yet
+        # message_identifier => [peer, ...]
+        self.announcers = OrderedDict()
+
+        # The part of join that runs after the routing table is filled,
+        # syncing is True until it's done (see join)
+        self.joining = None
+        self.syncing = False
+
     @rpc
     def ping(self, peer, peer_identifier):
-        logger.info('handling ping(%r, %r)', peer, peer_identifier)
+        trace('handling ping(%r, %r)', peer, peer_identifier)
 
         # The 1st identifier is consumed by kademlia
         # While the 2nd is sent as a reply back to the caller
         return (self.identifier, self.identifier)
 
     @rpc
-    def store(self, peer, peer_identifier, key, value):
-        logger.info('handling store(%r, %r, %r, %r)',
-                    peer, peer_identifier, key, value)
+    def store(self, peer, peer_identifier, key, value, ttl=None):
+        trace('handling store(%r, %r, %r, %r, ttl=%r)',
+              peer, peer_identifier, key, value, ttl)
 
-        self.storage[key] = value
+        self.storage.set(key, value, ttl=ttl or config.DHT_TTL)
         return (self.identifier, True)
 
     @rpc
     def find_node(self, peer, peer_identifier, key):
-        logger.info('handling find_node(from=%r, peer_id=%r, find=%r)',
-                    peer, peer_identifier, key)
+        trace('handling find_node(from=%r, peer_id=%r, find=%r)',
+              peer, peer_identifier, key)
 
         response = self.routing_table.find_closest_peers(key, excluding=peer_identifier)
         return (self.identifier, response)
 
     @rpc
     def find_value(self, peer, peer_identifier, key):
-        logger.info('handling find_value(%r, %r, %r)',
-                    peer, peer_identifier, key)
+        trace('handling find_value(%r, %r, %r)',
+              peer, peer_identifier, key)
 
         if key in self.storage:
             response = ('found', self.storage[key])
@@ -72,65 +114,367 @@ class KademliaNode(DatagramRPCProtocol):
         response = ('notfound', self.routing_table.find_closest_peers(key, excluding=peer_identifier))
         return (self.identifier, response)
 
+    @rpc
+    def store_many(self, peer, peer_identifier, items, ttl=None):
+        trace('handling store_many(%r, %r, %d items, ttl=%r)',
+              peer, peer_identifier, len(items), ttl)
+
+        for key, value in items:
+            self.storage.set(key, value, ttl=ttl or config.DHT_TTL)
+
+        return (self.identifier, True)
+
+    @rpc
+    def find_values(self, peer, peer_identifier, keys):
+        trace('handling find_values(%r, %r, %d keys)',
+              peer, peer_identifier, len(keys))
+
+        response = {key: self.storage[key] for key in keys if key in self.storage}
+        return (self.identifier, response)
+
+    @rpc
+    def get_stats(self, peer, peer_identifier):
+        return (self.identifier, self.stats())
+
+    @rpc
+    def profile(self, peer, peer_identifier, action):
+        # See Profiler.command for the actions
+        return (self.identifier, self.profiler.command(action))
+
+    def stats(self):
+        """
+        Per procedure metrics, along with the state of the routing table & storage.
+        """
+
+        return {
+            'identifier': self.identifier,
+            'address': self.socket_addr,
+            'peers': len(self.routing_table.index),
+            'syncing': self.syncing,
+            'outstanding_requests': len(self.outstanding_requests),
+            'storage': self.storage.stats(),
+            'pending_handlers': self.dispatcher.pending,
+            'metrics': self.metrics.snapshot(),
+        }
+
+    def update_peer(self, peer_identifier, peer):
+        """
+        Update the routing table, pinging the oldest peer of a full bucket.
+
+        http://xlattice.sourceforge.net/components/protocol/kademlia/specs.html#update
+        """
+
+        oldest = self.routing_table.update_peer(peer_identifier, peer)
+
+        if oldest is not None and oldest[0] not in self.pinging:
+            self.pinging.add(oldest[0])
+            asyncio.ensure_future(self.check_peer(*oldest))
+
     @asyncio.coroutine
-    def ping_all_neighbors(self):
-        for node_id, peer in list(self.routing_table):
+    def check_peer(self, peer_identifier, peer):
+        """
+        Ping a peer, and forget it if it doesn't reply.
+
+        Forgetting a peer moves someone from the replacement cache into its place.
+        """
+
+        try:
             yield from self.ping(peer, self.identifier)
+        except RPCBusy:
+            pass
+        except socket.timeout:
+            logger.info("Evicting unresponsive peer %r", peer)
+            self.routing_table.forget_peer(peer_identifier)
+        finally:
+            self.pinging.discard(peer_identifier)
+
+    @asyncio.coroutine
+    def ping_all_neighbors(self):
+        semaphore = asyncio.Semaphore(config.PING_CONCURRENCY)
+
+        @asyncio.coroutine
+        def bounded_check(node_id, peer):
+            yield from semaphore.acquire()
+            try:
+                yield from self.check_peer(node_id, peer)
+            finally:
+                semaphore.release()
+
+        yield from asyncio.gather(*[
+            bounded_check(node_id, peer)
+            for node_id, peer in list(self.routing_table)
+        ])
+
+    @asyncio.coroutine
+    def crawl(self, limit=1024):
+        """
+        Find peers beyond our routing table (atmost limit of them.)
+
+        Every peer found is asked for the peers closest to itself,
+        returns a dict of peer_identifier => peer.
+        """
+
+        found = dict(self.routing_table)
+        asked = set()
+
+        semaphore = asyncio.Semaphore(config.PING_CONCURRENCY)
+
+        @asyncio.coroutine
+        def neighbours(peer_identifier, peer):
+            yield from semaphore.acquire()
+            try:
+                return (yield from self.quietly(self.find_node(peer, self.identifier, peer_identifier)))
+            finally:
+                semaphore.release()
+
+        while len(found) < limit:
+            batch = [item for item in found.items() if item[0] not in asked]
+            if not batch:
+                break
+
+            asked.update(peer_identifier for peer_identifier, _ in batch)
+
+            for contacts in (yield from asyncio.gather(*[neighbours(*item) for item in batch])):
+                for peer_identifier, peer in contacts or []:
+                    if peer_identifier != self.identifier and len(found) < limit:
+                        found.setdefault(peer_identifier, peer)
+
+        return found
+
+    @asyncio.coroutine
+    def cluster_stats(self, limit=1024):
+        """
+        Stats of every peer we can find (None for those that didn't answer.)
+
+        Returns a dict of peer => stats, including our own.
+        """
+
+        peers = yield from self.crawl(limit)
+
+        semaphore = asyncio.Semaphore(config.PING_CONCURRENCY)
+
+        @asyncio.coroutine
+        def stats(peer):
+            yield from semaphore.acquire()
+            try:
+                return (yield from self.quietly(self.get_stats(peer, self.identifier)))
+            finally:
+                semaphore.release()
+
+        addresses = list(peers.values())
+        results = yield from asyncio.gather(*[stats(peer) for peer in addresses])
+
+        cluster = dict(zip(addresses, results))
+        cluster[self.socket_addr] = self.stats()
+
+        return cluster
 
     @asyncio.coroutine
-    def join(self, known_node):
+    def refresh_buckets(self):
+        """
+        Lookup a random id in every bucket that hasn't seen a lookup lately.
+        """
+
+        now = asyncio.get_event_loop().time()
+        stale = self.routing_table.stale_buckets(now, config.BUCKET_REFRESH_INTERVAL)
+
+        for index in stale:
+            try:
+                yield from self.lookup_node(self.routing_table.random_id_in_bucket(index))
+            except KeyError:
+                # Our routing table is empty
+                break
+
+    @asyncio.coroutine
+    def join(self, known_nodes, background=False):
         """
         Run by a node when it wants to join the network.
 
+        known_nodes can be a single bootstrap address or a list of them,
+        the first one (in random order) that replies is used.
+
+        The node can route requests as soon as it has found its closest
+        peers. With background=True join returns then, and announcing
+        myself & syncing the ledger carry on in self.joining (while
+        self.syncing is True.)
+
         http://xlattice.sourceforge.net/components/protocol/kademlia/specs.html#join
         """
 
-        # When a new node is created, ping some known_node
-        logger.info("Pinging %r", known_node)
+        if isinstance(known_nodes, tuple):
+            known_nodes = [known_nodes]
 
-        try:
-            yield from self.ping(known_node, self.identifier)
-        except socket.timeout:
-            logger.warn("Could not ping %r", known_node)
-            return
+        # Peers restored from a snapshot of our last run
+        warm = len(self.routing_table.index) > 0
+
+        if warm:
+            logger.info("Rejoining via %d peers from the last run", len(self.routing_table.index))
+        else:
+            known_node = yield from self.pick_bootstrap(known_nodes)
+            if known_node is None:
+                return
 
         # Try to find all peers close to myself
         # (this'll update my routing table)
-        yield from self.lookup_node(self.identifier)
+        try:
+            closest = yield from self.lookup_node(self.identifier)
+        except KeyError:
+            closest = []
+
+        if warm and not closest:
+            logger.info("None of the peers from the last run are alive")
+            return (yield from self.join(known_nodes, background))
+
+        if warm:
+            # Spare the bootstrappers, any live peer will do
+            known_node = closest[0][1]
+
+        self.syncing = True
+        self.joining = asyncio.ensure_future(self.finish_join(known_node, warm))
+
+        if not background:
+            yield from self.joining
 
-        # Pinging all neighbors will update their routing tables
-        logger.info("Pinging all neighbors")
-        yield from self.ping_all_neighbors()
+    @asyncio.coroutine
+    def finish_join(self, known_node, warm):
+        """
+        The rest of join, once my routing table has my closest peers in it.
+        """
 
         try:
-            # Check if my public key is already in the network
-            yield from self.get(self.identifier)
-        except KeyError:
+            if warm:
+                # Check the rest of the restored peers in the background
+                asyncio.ensure_future(self.ping_all_neighbors())
+            else:
+                # Pinging all neighbors will update their routing tables
+                logger.info("Pinging all neighbors")
+                yield from self.ping_all_neighbors()
+
             # Store my information onto the network
-            # (allowing others to find me)
+            # (allowing others to find me, at my current address)
             yield from self.put(self.identifier, (self.socket_addr, self.pub_key))
 
-            logger.info("Sending my genesis transaction %r", self.ledger.genesis_tx)
-            yield from self.add_tx_to_ledger(known_node, self.identifier, self.ledger.genesis_tx)  # add it to the ledger of bootstrapper
+            # Download the ledger from peers close to me
+            # (after a restart, whatever I missed while I was away)
+            yield from self.sync_ledger(known_node)
+
+            # Whether this is my first join is up to my ledger, not the DHT
+            # (which still has my key after a restart)
+            if not self.ledger.joined:
+                earlier = [
+                    tx for tx in self.ledger.touching(self.identifier)
+                    if tx.sender is None and tx != self.ledger.genesis_tx
+                ]
+
+                if earlier:
+                    # I've joined before, but lost the snapshot of my ledger
+                    logger.info("Found my genesis transaction %r", earlier[0])
+                    self.ledger.remove_tx(self.ledger.genesis_tx)
+                    self.ledger.genesis_tx = earlier[0]
+                else:
+                    logger.info("Sending my genesis transaction %r", self.ledger.genesis_tx)
+                    self.ledger.add_tx(self.ledger.genesis_tx)
+                    yield from self.quietly(self.add_tx_to_ledger(known_node, self.identifier, self.ledger.genesis_tx))  # add it to the ledger of bootstrapper
+                    yield from self.broadcast(random_id(), 'add_tx_to_ledger', self.identifier, self.ledger.genesis_tx)  # broadcast my genesis transaction to everyone
+
+                self.ledger.joined = True
+        finally:
+            self.syncing = False
 
-            ledger_bootstrap = yield from self.get_ledger(known_node, self.identifier)  # get the bootstrapper's ledger
-            logger.info("Got Ledger %r", ledger_bootstrap)
-            self.ledger.record = ledger_bootstrap.record  # replace my ledger with that of bootstrappers
+    @asyncio.coroutine
+    def pick_bootstrap(self, known_nodes):
+        """
+        Ping bootstrap nodes in random order, returns the first to reply.
+        """
 
-            yield from self.broadcast(random_id(), 'add_tx_to_ledger', self.identifier, self.ledger.genesis_tx)  # broadcast my genesis transaction to everyone
+        for known_node in random.sample(known_nodes, len(known_nodes)):
+            logger.info("Pinging %r", known_node)
+
+            try:
+                yield from self.ping(known_node, self.identifier)
+                return known_node
+            except (socket.timeout, RPCBusy):
+                logger.warn("Could not ping %r", known_node)
+
+        return None
+
+    def save_state(self, path):
+        """
+        Snapshot the routing table & storage to a file (atomically.)
+        """
+
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(self.dump_state(), f)
+
+        os.replace(path + '.tmp', path)
+
+    def dump_state(self):
+        return {
+            'identifier': self.identifier,
+            'routing_table': self.routing_table.snapshot(),
+            'storage': self.storage.snapshot(),
+        }
+
+    def load_state(self, path):
+        """
+        Restore a snapshot saved by save_state, returns False if there's none.
+        """
+
+        if not os.path.exists(path):
+            return False
+
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            logger.warn("Could not load state from %r: %r", path, e)
+            return False
+
+        self.restore_state(state)
+
+        logger.info("Restored %d peers and %d values from %r",
+                    len(self.routing_table.index), len(self.storage), path)
+
+        return True
+
+    def restore_state(self, state):
+        self.routing_table.restore(state['routing_table'])
+
+        # Values published by whoever saved this snapshot (if that wasn't
+        # me, e.g. its identity record) never expire, so they'd be
+        # republished forever - keep just my own
+        mine = state.get('identifier') == self.identifier
+        snapshot = [
+            (key, value, ttl, owned) for key, value, ttl, owned in state['storage']
+            if not owned or mine
+        ]
+
+        self.storage.restore(snapshot)
 
     # TODO: Refactor the hashed part
     @asyncio.coroutine
-    def put(self, raw_key, value, hashed=True):  # hashed True key being passed is already hashe
+    def put(self, raw_key, value, hashed=True, ttl=None):  # hashed True key being passed is already hashe
+        """
+        Store a value at the k nodes closest to the key.
+
+        The value expires after ttl seconds, until then we keep a copy
+        and periodically republish it.
+        """
         if(not hashed):  # hashed False => key passed needs to be hashed to 160bit
             hashed_key = sha1_int(raw_key)
         else:
             hashed_key = raw_key  # dht key is node_id already hashed
 
+        self.storage.set(hashed_key, value, ttl=ttl, owned=True)
+
+        return (yield from self.replicate(hashed_key, value, ttl or config.DHT_TTL))
+
+    @asyncio.coroutine
+    def replicate(self, hashed_key, value, ttl):
         peers_close_to_key = yield from self.lookup_node(hashed_key, find_value=False)
 
         store_tasks = [
-            self.store(peer, self.identifier, hashed_key, value)
+            self.store(peer, self.identifier, hashed_key, value, ttl=ttl)
             for _, peer in peers_close_to_key
         ]
 
@@ -139,6 +483,156 @@ class KademliaNode(DatagramRPCProtocol):
 
         return len(successful)
 
+    @asyncio.coroutine
+    def republish(self):
+        """
+        Drop expired values and push the rest to the current k closest nodes.
+
+        http://xlattice.sourceforge.net/components/protocol/kademlia/specs.html#STORE
+        """
+
+        self.storage.expire()
+
+        for key in self.storage.due_for_republish(config.REPUBLISH_INTERVAL):
+            if key not in self.storage:
+                continue
+
+            value = self.storage[key]
+
+            # Replicas go out with what's left of their ttl,
+            # my own values (that never expire here) with a fresh one
+            ttl = self.storage.ttl(key)
+            if ttl is None:
+                ttl = config.DHT_TTL
+
+            self.storage.mark_republished(key)
+
+            try:
+                yield from self.replicate(key, value, ttl)
+            except KeyError:
+                # Our routing table is empty
+                break
+
+    @asyncio.coroutine
+    def put_many(self, items, hashed=True, ttl=None):
+        """
+        Store many (key, value) pairs, sharing lookups between nearby keys.
+
+        Returns a dict of the number of nodes each key was stored at.
+        """
+        if not hashed:
+            items = {sha1_int(raw_key): value for raw_key, value in items.items()}
+
+        for hashed_key, value in items.items():
+            self.storage.set(hashed_key, value, ttl=ttl, owned=True)
+
+        @asyncio.coroutine
+        def put_region(keys):
+            candidates = yield from self.lookup_region(keys)
+
+            # Send each peer all the keys it is among the k closest to
+            batches = defaultdict(list)
+            for hashed_key in keys:
+                for peer in sorted(candidates, key=lambda p: (p[0] ^ hashed_key, p[1]))[:self.k]:
+                    batches[peer].append((hashed_key, items[hashed_key]))
+
+            batches = list(batches.items())
+            results = yield from asyncio.gather(*[
+                self.store_many(peer, self.identifier, batch, ttl=ttl or config.DHT_TTL)
+                for (_, peer), batch in batches
+            ], return_exceptions=True)
+
+            for (_, batch), result in zip(batches, results):
+                if result is True:
+                    for hashed_key, _ in batch:
+                        stored[hashed_key] += 1
+
+        stored = {hashed_key: 0 for hashed_key in items}
+        yield from asyncio.gather(*[put_region(keys) for keys in self.regions(items)])
+
+        return stored
+
+    @asyncio.coroutine
+    def get_many(self, raw_keys, hashed=True):
+        """
+        Get the values of many keys, sharing lookups between nearby keys.
+
+        Only keys that share a DHT_BATCH_PREFIX_BITS prefix share a lookup,
+        so a handful of unrelated keys is better off with concurrent gets.
+
+        Returns a dict of the keys that were found (keys as they were passed.)
+        """
+        if not hashed:
+            hashed_keys = {sha1_int(raw_key): raw_key for raw_key in raw_keys}
+        else:
+            hashed_keys = {raw_key: raw_key for raw_key in raw_keys}
+
+        found = {
+            hashed_key: self.storage[hashed_key]
+            for hashed_key in hashed_keys if hashed_key in self.storage
+        }
+
+        @asyncio.coroutine
+        def get_region(keys):
+            candidates = yield from self.lookup_region(keys)
+
+            def distance(peer): return (peer[0] ^ keys[0], peer[1])
+            candidates = sorted(candidates, key=distance)
+
+            # Ask the closest few peers about all the keys they may have,
+            # then the next few about the ones still missing and so on
+            for i in range(0, len(candidates), self.alpha):
+                missing = [hashed_key for hashed_key in keys if hashed_key not in found]
+                if not missing:
+                    return
+
+                results = yield from asyncio.gather(*[
+                    self.find_values(peer, self.identifier, missing)
+                    for _, peer in candidates[i:i + self.alpha]
+                ], return_exceptions=True)
+
+                for result in results:
+                    if isinstance(result, dict):
+                        found.update(result)
+
+            # Whatever the batch couldn't find gets a lookup of its own
+            for hashed_key in keys:
+                if hashed_key not in found:
+                    try:
+                        found[hashed_key] = yield from self.get(hashed_key)
+                    except KeyError:
+                        pass
+
+        missing = [hashed_key for hashed_key in hashed_keys if hashed_key not in found]
+        yield from asyncio.gather(*[get_region(keys) for keys in self.regions(missing)])
+
+        return {hashed_keys[hashed_key]: value for hashed_key, value in found.items()}
+
+    def regions(self, hashed_keys):
+        """
+        Group keys that share their leading DHT_BATCH_PREFIX_BITS bits.
+        """
+
+        shift = 160 - config.DHT_BATCH_PREFIX_BITS
+
+        groups = defaultdict(list)
+        for hashed_key in sorted(hashed_keys):
+            groups[hashed_key >> shift].append(hashed_key)
+
+        return list(groups.values())
+
+    @asyncio.coroutine
+    def lookup_region(self, hashed_keys):
+        """
+        Peers close to a group of nearby keys, found by a single lookup.
+        """
+
+        # Look up the middle key of the group
+        visited = {}
+        closest = yield from self.lookup_node(hashed_keys[len(hashed_keys) // 2], visited=visited)
+
+        return set(closest) | set(visited)
+
     @asyncio.coroutine
     def get(self, raw_key, hashed=True):  # hashed True key being passed is already hashe
         if(not hashed):  # hashed False => key passed needs to be hashed to 160bit
@@ -147,19 +641,66 @@ class KademliaNode(DatagramRPCProtocol):
             hashed_key = raw_key
         if hashed_key in self.storage:
             return self.storage[hashed_key]
+
+        visited = {}
         try:
-            response = yield from self.lookup_node(hashed_key, find_value=True)
+            response = yield from self.lookup_node(hashed_key, find_value=True, visited=visited)
         except KeyError as e:
             raise e
 
+        self.cache_on_path(hashed_key, response, visited)
+
         return response
 
-    @asyncio.coroutine
-    def lookup_node(self, hashed_key, find_value=False):
+    def cache_on_path(self, hashed_key, value, visited):
+        """
+        Store a found value at the closest visited node that didn't have it.
+
+        http://xlattice.sourceforge.net/components/protocol/kademlia/specs.html#FIND_VALUE
+        """
         def distance(peer): return peer[0] ^ hashed_key
 
+        holders = [peer for peer, had_value in visited.items() if had_value]
+        lacking = [peer for peer, had_value in visited.items() if not had_value]
+
+        if not holders or not lacking:
+            return
+
+        holder = min(holders, key=distance)
+        cache_identifier, cache_peer = min(lacking, key=distance)
+
+        # The further away from the key, the sooner the cached copy expires
+        bits = max(0, (cache_identifier ^ hashed_key).bit_length() - distance(holder).bit_length())
+        ttl = max(1, config.PATH_CACHE_TTL >> bits)
+
+        asyncio.ensure_future(self.quietly(self.store(cache_peer, self.identifier, hashed_key, value, ttl=ttl)))
+
+    @asyncio.coroutine
+    def quietly(self, request):
+        """
+        Await a request whose failure nobody cares about (None if it failed.)
+        """
+        try:
+            return (yield from request)
+        except (socket.timeout, RPCBusy):
+            return None
+
+    @asyncio.coroutine
+    def lookup_node(self, hashed_key, find_value=False, visited=None):
+        """
+        Iteratively find the k nodes closest to hashed_key (or its value.)
+
+        If visited is a dict, it's filled with every peer that answered,
+        mapped to whether that peer had the value.
+        """
+        # An identifier may turn up at two addresses (one of them stale),
+        # those are ordered by address rather than by how the set hashes
+        def distance(peer): return (peer[0] ^ hashed_key, peer[1])
+
         contacted, dead = set(), set()
 
+        self.routing_table.touch_bucket(hashed_key, asyncio.get_event_loop().time())
+
         peers = {
             (peer_identifier, peer)
             for peer_identifier, peer in
@@ -169,40 +710,83 @@ class KademliaNode(DatagramRPCProtocol):
         if not peers:
             raise KeyError(hashed_key, 'No peers available.')
 
-        while True:
-            uncontacted = peers - contacted
+        # Rounds of (upto alpha) parallel requests
+        hops = 0
 
-            if not uncontacted:
-                break
+        # (value,) once a peer has returned it
+        value = None
 
-            closest = sorted(uncontacted, key=distance)[:self.alpha]
+        try:
+            while True:
+                uncontacted = peers - contacted
 
-            for peer_identifier, peer in closest:
+                if not uncontacted:
+                    break
 
-                contacted.add((peer_identifier, peer))
+                closest = sorted(uncontacted, key=distance)[:self.alpha]
+                contacted.update(closest)
+                hops += 1
 
-                try:
-                    if find_value:
-                        result, contacts = yield from self.find_value(peer, self.identifier, hashed_key)
-                        if result == 'found':
-                            return contacts
-                    else:
-                        contacts = yield from self.find_node(peer, self.identifier, hashed_key)
+                answers = yield from asyncio.gather(*[
+                    self.ask_peer(peer, hashed_key, find_value)
+                    for _, peer in closest
+                ], return_exceptions=True)
 
-                except socket.timeout:
-                    self.routing_table.forget_peer(peer_identifier)
-                    dead.add((peer_identifier, peer))
-                    continue
+                for (peer_identifier, peer), answer in zip(closest, answers):
 
-                for new_peer_identifier, new_peer in contacts:
-                    if new_peer_identifier == self.identifier:
+                    if isinstance(answer, socket.timeout):
+                        self.routing_table.forget_peer(peer_identifier)
+                        dead.add((peer_identifier, peer))
                         continue
-                    peers.add((new_peer_identifier, new_peer))
+
+                    if isinstance(answer, RPCBusy):
+                        # Alive, but can't help us right now
+                        continue
+
+                    if isinstance(answer, Exception):
+                        raise answer
+
+                    found, contacts = answer
+
+                    if visited is not None:
+                        visited[(peer_identifier, peer)] = found
+
+                    if found:
+                        value = (contacts,)
+                        continue
+
+                    for new_peer_identifier, new_peer in contacts:
+                        if new_peer_identifier == self.identifier:
+                            continue
+                        peers.add((new_peer_identifier, new_peer))
+
+                # Only once the whole round is in visited
+                if value:
+                    return value[0]
+
+            if find_value:
+                raise KeyError(hashed_key, 'Not found among any available peers.')
+            else:
+                return sorted(peers - dead, key=distance)[:self.k]
+
+        finally:
+            kind = 'find_value' if find_value else 'find_node'
+            self.metrics.observe('lookup_hops', kind, hops, bounds=COUNT_BUCKETS)
+            self.metrics.observe('lookup_contacted', kind, len(contacted), bounds=COUNT_BUCKETS)
+
+    @asyncio.coroutine
+    def ask_peer(self, peer, hashed_key, find_value):
+        """
+        One step of a lookup: (True, value) if peer has the value,
+        (False, contacts) otherwise.
+        """
 
         if find_value:
-            raise KeyError(hashed_key, 'Not found among any available peers.')
-        else:
-            return sorted(peers - dead, key=distance)[:self.k]
+            result, contacts = yield from self.find_value(peer, self.identifier, hashed_key)
+            return (result == 'found', contacts)
+
+        contacts = yield from self.find_node(peer, self.identifier, hashed_key)
+        return (False, contacts)
 
     @asyncio.coroutine
     def broadcast(self, message_identifier, procedure_name, *args, **kwargs):
@@ -215,14 +799,104 @@ class KademliaNode(DatagramRPCProtocol):
             procedure_name : name of the remote procedure to be executed
             args : parameters for that procedure
         """
-        logger.info("sending a broadcast of procedure %r transaction: %r", procedure_name, args[1:])
+        trace("sending a broadcast of procedure %r transaction: %r", procedure_name, args[1:])
         if message_identifier not in self.broadcast_list:
             self.broadcast_list.append(message_identifier)
 
-        # Create a mesage with its type, procedure_name and args
-        obj = ('broadcast', message_identifier, procedure_name, *args)
+        if self.broadcast_mode == 'inv':
+            # Keep the payload around for peers that ask for it,
+            # but only announce the message id to them
+            self.broadcast_payloads[message_identifier] = (procedure_name, args)
+            bounded(self.broadcast_payloads, config.BROADCAST_CACHE_SIZE)
+
+            obj = ('inv', message_identifier, self.identifier)
+        else:
+            # Create a mesage with its type, procedure_name and args
+            obj = ('broadcast', message_identifier, procedure_name, *args)
+
         message = pickle.dumps(obj, protocol=0)
 
-        # Send the msg to each connected peer
+        # Send the msg to each connected peer that hasn't seen it yet
         for _, peer in self.routing_table:
-            self.transport.sendto(message, peer)
+            if self.has_seen(peer, message_identifier):
+                continue
+
+            self.mark_seen(peer, message_identifier)
+            self.send_datagram(message, peer, procedure_name)
+
+    def has_seen(self, peer, message_identifier):
+        return message_identifier in self.seen_filters[peer]
+
+    def mark_seen(self, peer, message_identifier):
+        seen = self.seen_filters[peer]
+        seen[message_identifier] = None
+        bounded(seen, config.SEEN_FILTER_SIZE)
+
+    def inv_received(self, peer, message_identifier, peer_identifier):
+        """
+        A peer announced a broadcast; fetch it unless we already have it.
+        """
+        trace("received inv %r from %r", message_identifier, peer)
+
+        self.update_peer(peer_identifier, peer)
+        self.mark_seen(peer, message_identifier)
+
+        if message_identifier in self.broadcast_list:
+            return
+
+        announcers = self.announcers.setdefault(message_identifier, [])
+        if peer not in announcers:
+            announcers.append(peer)
+        bounded(self.announcers, config.BROADCAST_CACHE_SIZE)
+
+        # Someone was already asked for this payload
+        # (and will be asked again if they don't answer)
+        if message_identifier in self.requested_broadcasts:
+            return
+
+        self.request_broadcast(message_identifier, config.GETDATA_RETRIES)
+
+    def request_broadcast(self, message_identifier, retries):
+        """
+        Send a getdata to the next peer that announced message_identifier,
+        and check back after reply_timeout seconds.
+        """
+
+        announcers = self.announcers.get(message_identifier)
+
+        if message_identifier in self.broadcast_list or not announcers or retries < 0:
+            self.requested_broadcasts.pop(message_identifier, None)
+            self.announcers.pop(message_identifier, None)
+            return
+
+        # Take turns, so that a retry goes to someone else (if we can)
+        peer = announcers.pop(0)
+        announcers.append(peer)
+
+        loop = asyncio.get_event_loop()
+
+        self.requested_broadcasts[message_identifier] = loop.time()
+        bounded(self.requested_broadcasts, config.BROADCAST_CACHE_SIZE)
+
+        obj = ('getdata', message_identifier, self.identifier)
+        message = pickle.dumps(obj, protocol=0)
+        self.send_datagram(message, peer, 'getdata')
+
+        loop.call_later(self.reply_timeout, self.request_broadcast, message_identifier, retries - 1)
+
+    def getdata_received(self, peer, message_identifier, peer_identifier):
+        """
+        A peer asked for the payload of a broadcast we announced.
+        """
+        trace("received getdata %r from %r", message_identifier, peer)
+
+        self.mark_seen(peer, message_identifier)
+
+        if message_identifier not in self.broadcast_payloads:
+            return
+
+        procedure_name, args = self.broadcast_payloads[message_identifier]
+
+        obj = ('broadcast', message_identifier, procedure_name, *args)
+        message = pickle.dumps(obj, protocol=0)
+        self.send_datagram(message, peer, procedure_name)
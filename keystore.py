@@ -0,0 +1,74 @@
+"""
+Node identities - (identifier, public key, private key) - kept on disk.
+
+Loading an identity is much cheaper than generating a key pair, and a
+restarted node stays the same account, so the state, WAL & archive files
+named after its identifier are picked up again.
+
+Usage: keystore.py ip port count
+(generates identities for count nodes on consecutive ports, ahead of time)
+"""
+
+import json
+import os
+import sys
+
+import config
+
+from utils import gen_pub_pvt, random_id
+
+
+def key_path(sock_addr):
+    if not os.path.exists(config.KEYSTORE_DIR):
+        os.mkdir(config.KEYSTORE_DIR)
+
+    return os.path.join(config.KEYSTORE_DIR, "%s_%d.key" % sock_addr)
+
+
+def new_identity():
+    return (random_id(), ) + gen_pub_pvt()
+
+
+def load_identity(path):
+    """
+    The identity stored at path, or None if there isn't one.
+    """
+
+    try:
+        with open(path) as f:
+            identity = json.load(f)
+    except FileNotFoundError:
+        return None
+
+    return identity['identifier'], identity['pub_key'], identity['pvt_key']
+
+
+def save_identity(path, identity):
+    identifier, pub_key, pvt_key = identity
+
+    # Only readable by us, it has the private key
+    fd = os.open(path + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump({'identifier': identifier, 'pub_key': pub_key, 'pvt_key': pvt_key}, f)
+
+    os.replace(path + '.tmp', path)
+
+
+def load_or_create(path):
+    identity = load_identity(path)
+
+    if identity is None:
+        identity = new_identity()
+        save_identity(path, identity)
+
+    return identity
+
+
+if __name__ == '__main__':
+
+    ip, port, count = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+
+    for i in range(count):
+        load_or_create(key_path((ip, port + i)))
+
+    print("%d identities in %s" % (count, config.KEYSTORE_DIR))
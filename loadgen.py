@@ -0,0 +1,241 @@
+import argparse
+import asyncio
+import json
+import random
+import socket
+import time
+
+from collections import defaultdict
+
+from node import Node
+from rpc_protocol import RPCBusy
+from simnet import SimulatedNetwork, start_nodes, use_virtual_time
+from start_node import two_phase_protocol
+
+
+class LoadGenerator(object):
+
+    """
+    Makes random transfers between nodes & follows each one until every
+    node has committed it (or the sender has aborted it.)
+    """
+
+    def __init__(self, nodes, rng, zipf=0, amount=5, timeout=30):
+
+        self.nodes = nodes
+        self.rng = rng
+        self.amount = amount
+        self.timeout = timeout
+
+        # Senders are picked with probability proportional to 1 / rank ** zipf
+        # (so zipf=0 is uniform)
+        self.weights = [1 / (rank ** zipf) for rank in range(1, len(nodes) + 1)]
+
+        # transaction id => nodes that have committed it
+        self.commits = defaultdict(set)
+
+        # Transaction ids that were aborted, and (sender identifier =>) the
+        # id of the transfer each sender started last. Either may happen
+        # before send_amount's reply gets back to us.
+        self.aborts = set()
+        self.prepared = {}
+
+        # transaction id => future, done once it's committed everywhere
+        self.pending = {}
+
+        self.issued = 0
+        self.rejected = 0
+        self.aborted = 0
+        self.timed_out = 0
+
+        # Seconds from send_amount to the last node committing
+        self.latencies = []
+
+        for node in nodes:
+            node.on_commit.append(self.committed)
+            node.on_abort.append(self.aborted_tx)
+            node.on_prepare.append(self.prepared_tx)
+
+    def committed(self, node, txs):
+        tx_id = txs[0].id
+        self.commits[tx_id].add(node.identifier)
+
+        if len(self.commits[tx_id]) == len(self.nodes):
+            self.resolve(tx_id, 'committed')
+
+    def aborted_tx(self, node, txs):
+        if node.identifier == txs[0].sender:
+            self.aborts.add(txs[0].id)
+            self.resolve(txs[0].id, 'aborted')
+
+    def prepared_tx(self, node, txs):
+        self.prepared[node.identifier] = txs[0].id
+
+    def resolve(self, tx_id, outcome):
+        future = self.pending.get(tx_id)
+
+        if future is not None and not future.done():
+            future.set_result(outcome)
+
+    def pick(self):
+        sender = self.rng.choices(self.nodes, self.weights)[0]
+        receiver, witness = self.rng.sample([node for node in self.nodes if node is not sender], 2)
+
+        return sender, receiver, witness
+
+    @asyncio.coroutine
+    def transfer(self):
+        loop = asyncio.get_event_loop()
+        sender, receiver, witness = self.pick()
+
+        self.issued += 1
+        started = loop.time()
+
+        try:
+            response = yield from sender.send_amount(
+                sender.socket_addr, sender.identifier, receiver.identifier, witness.identifier, self.amount)
+        except (socket.timeout, RPCBusy):
+            response = None
+
+        # Not enough balance, or the sender is busy with another transfer
+        if not response or not response.startswith("Initiating"):
+            self.rejected += 1
+            return
+
+        # The sender may well be done with it (and so not busy) by now
+        tx_id = self.prepared.pop(sender.identifier)
+
+        future = self.pending[tx_id] = asyncio.Future()
+        if len(self.commits.get(tx_id, ())) == len(self.nodes):
+            future.set_result('committed')
+        elif tx_id in self.aborts:
+            future.set_result('aborted')
+
+        try:
+            outcome = yield from asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            outcome = 'timed out'
+        finally:
+            del self.pending[tx_id]
+            self.commits.pop(tx_id, None)
+            self.aborts.discard(tx_id)
+
+        if outcome == 'committed':
+            self.latencies.append(loop.time() - started)
+        elif outcome == 'aborted':
+            self.aborted += 1
+        else:
+            self.timed_out += 1
+
+    @asyncio.coroutine
+    def open_loop(self, rate, duration):
+        """
+        Start rate transfers per second, whether or not earlier ones are done.
+        """
+
+        loop = asyncio.get_event_loop()
+        end = loop.time() + duration
+
+        transfers = []
+        while loop.time() < end:
+            transfers.append(asyncio.ensure_future(self.transfer()))
+            yield from asyncio.sleep(1 / rate)
+
+        yield from asyncio.gather(*transfers)
+
+    @asyncio.coroutine
+    def closed_loop(self, concurrency, duration):
+        """
+        Keep concurrency transfers going at all times.
+        """
+
+        loop = asyncio.get_event_loop()
+        end = loop.time() + duration
+
+        @asyncio.coroutine
+        def worker():
+            while loop.time() < end:
+                yield from self.transfer()
+
+        yield from asyncio.gather(*[worker() for _ in range(concurrency)])
+
+    def report(self, elapsed, datagrams):
+        committed = len(self.latencies)
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+
+            return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+        return {
+            'issued': self.issued,
+            'committed': committed,
+            'rejected': self.rejected,
+            'aborted': self.aborted,
+            'timed_out': self.timed_out,
+            'throughput': committed / elapsed,
+            'abort_rate': self.aborted / max(1, committed + self.aborted),
+            'latency_p50': percentile(50),
+            'latency_p95': percentile(95),
+            'latency_p99': percentile(99),
+            'datagrams_per_tx': datagrams / max(1, committed),
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate transfers on a simulated network of nodes.')
+    parser.add_argument('--nodes', type=int, default=10)
+    parser.add_argument('--rate', type=float, help='transfers started per second (open loop)')
+    parser.add_argument('--concurrency', type=int, default=4, help='transfers in flight (closed loop, the default)')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to generate load for')
+    parser.add_argument('--zipf', type=float, default=0, help='skew of sender selection (default: 0, uniform)')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for a transfer to commit everywhere')
+    parser.add_argument('--latency', type=float, default=0.01)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--virtual', action='store_true', help='run on a virtual clock')
+    parser.add_argument('--json', metavar='FILE', help='also write the report to FILE')
+
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+
+    if args.virtual:
+        use_virtual_time()
+
+    loop = asyncio.get_event_loop()
+    network = SimulatedNetwork(latency=args.latency, loss=args.loss, seed=args.seed)
+
+    # Joining one at a time, so that everyone's genesis reaches everyone
+    nodes = loop.run_until_complete(start_nodes(network, args.nodes, Node, concurrency=1))
+    loop.run_until_complete(asyncio.sleep(5))
+
+    for node in nodes:
+        loop.create_task(two_phase_protocol(node))
+
+    generator = LoadGenerator(nodes, random.Random(args.seed), zipf=args.zipf, timeout=args.timeout)
+
+    if args.rate:
+        load = generator.open_loop(args.rate, args.duration)
+    else:
+        load = generator.closed_loop(args.concurrency, args.duration)
+
+    started, sent, wall = loop.time(), network.sent, time.time()
+    loop.run_until_complete(load)
+
+    report = generator.report(loop.time() - started, network.sent - sent)
+
+    for key, value in report.items():
+        print("%-20s %s" % (key, "%.4f" % value if isinstance(value, float) else value))
+
+    print("(took %.2fs of real time)" % (time.time() - wall))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
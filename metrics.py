@@ -0,0 +1,118 @@
+import json
+import os
+
+from collections import defaultdict
+
+# Upper bounds of histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20, 30, 50, 100)
+
+
+class Histogram(object):
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+
+        # counts[i] is the number of values <= bounds[i] (but > bounds[i - 1])
+        # and the last one counts values larger than all bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': list(zip(self.bounds + ('+Inf', ), self.counts)),
+        }
+
+
+class Metrics(object):
+
+    """
+    Counters & histograms, each labelled by (usually) a procedure name.
+    """
+
+    def __init__(self):
+
+        # (name, label) => int
+        self.counters = defaultdict(int)
+
+        # (name, label) => Histogram
+        self.histograms = {}
+
+    def inc(self, name, label, value=1):
+        self.counters[(name, label)] += value
+
+    def observe(self, name, label, value, bounds=LATENCY_BUCKETS):
+        if (name, label) not in self.histograms:
+            self.histograms[(name, label)] = Histogram(bounds)
+
+        self.histograms[(name, label)].observe(value)
+
+    def snapshot(self):
+        """
+        Everything as plain dicts: {name: {label: value}}
+        """
+
+        counters = defaultdict(dict)
+        for (name, label), value in self.counters.items():
+            counters[name][label] = value
+
+        histograms = defaultdict(dict)
+        for (name, label), histogram in self.histograms.items():
+            histograms[name][label] = histogram.snapshot()
+
+        return {'counters': dict(counters), 'histograms': dict(histograms)}
+
+
+def prometheus(snapshot, prefix='ledger'):
+    """
+    Render a Metrics.snapshot() in the Prometheus text format.
+    """
+
+    lines = []
+
+    for name, values in sorted(snapshot['counters'].items()):
+        lines.append('# TYPE %s_%s counter' % (prefix, name))
+        for label, value in sorted(values.items()):
+            lines.append('%s_%s{procedure="%s"} %d' % (prefix, name, label, value))
+
+    for name, values in sorted(snapshot['histograms'].items()):
+        lines.append('# TYPE %s_%s histogram' % (prefix, name))
+        for label, histogram in sorted(values.items()):
+            # Prometheus buckets are cumulative
+            total = 0
+            for bound, count in histogram['buckets']:
+                total += count
+                lines.append('%s_%s_bucket{procedure="%s",le="%s"} %d' % (prefix, name, label, bound, total))
+
+            lines.append('%s_%s_sum{procedure="%s"} %r' % (prefix, name, label, histogram['sum']))
+            lines.append('%s_%s_count{procedure="%s"} %d' % (prefix, name, label, histogram['count']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def dump(stats, path):
+    """
+    Write stats (atomically) to path, as Prometheus text if it ends in .prom
+    and as JSON otherwise.
+    """
+
+    with open(path + '.tmp', 'w') as f:
+        if path.endswith('.prom'):
+            f.write(prometheus(stats['metrics']))
+        else:
+            json.dump(stats, f, indent=2, sort_keys=True, default=str)
+
+    os.replace(path + '.tmp', path)
@@ -1,22 +1,40 @@
+import asyncio
 import logging
 
+from collections import OrderedDict
+
+import config
+
 from kademlia_dht import KademliaNode, rpc
-from utils import gen_pub_pvt, verify_msg
+from utils import gen_pub_pvt, verify_msg, shard_key, random_id, bounded
 
-from transaction import Ledger
+from transaction import Ledger, LightLedger, ShardedLedger
+from wal import WriteAheadLog
 
-logger = logging.getLogger(__name__)
+logger = logging.getLogger('node.ledger')
 
 
 class Node(KademliaNode):
 
-    def __init__(self):
+    def __init__(self, light=config.LIGHT_NODE, sharded=config.SHARDED_LEDGER, identity=None):
+
+        # (identifier, public key, private key) from the keystore, if any
+        identifier, pub_key, pvt_key = identity or (None, None, None)
 
         # Initialize KademliaNode
-        super(Node, self).__init__()
+        super(Node, self).__init__(identifier=identifier)
+
+        # Light nodes don't keep (or sync) the whole ledger
+        self.light = light
 
-        # Generate public private key pair
-        self.pub_key, self.pvt_key = gen_pub_pvt()
+        # Sharded nodes only keep the part of the ledger in their shard
+        self.sharded = sharded and not light
+
+        # Generate public private key pair (unless we've got one)
+        if pub_key is None:
+            pub_key, pvt_key = gen_pub_pvt()
+
+        self.pub_key, self.pvt_key = pub_key, pvt_key
 
         # Am I busy handling some transaction? (Status, Transaction)
         self.isbusy = (False, None)
@@ -27,7 +45,26 @@ class Node(KademliaNode):
         self.broadcast_list = []
 
         # My list of transactions
-        self.ledger = Ledger(self.identifier)
+        if self.light:
+            self.ledger = LightLedger(self.identifier)
+        elif self.sharded:
+            self.ledger = ShardedLedger(self.identifier, self.owns_account)
+        else:
+            self.ledger = Ledger(self.identifier)
+
+        # Changes to the ledger & isbusy are logged here (see open_wal)
+        self.wal = None
+
+        # transaction id => ids of the inputs its commit marked spent
+        # (so that abort_tx can revert them)
+        self.undo_log = OrderedDict()
+
+        # Callbacks, called with (node, txs) when txs are committed to
+        # (or aborted from) this node's ledger, and when this node starts
+        # a two phase commit of txs as their sender
+        self.on_commit = []
+        self.on_abort = []
+        self.on_prepare = []
 
         # These are used by DatagramRPCProtocol
         self.reply_functions = self.find_reply_functions()
@@ -42,6 +79,211 @@ class Node(KademliaNode):
             for func in funcs if hasattr(func, 'remote_name')
         }
 
+    def owns_account(self, account):
+        """
+        Am I among the SHARD_REPLICAS nodes closest to the account's shard key?
+        """
+
+        key = shard_key(account)
+        my_distance = self.identifier ^ key
+
+        closest = self.routing_table.find_closest_peers(key, k=config.SHARD_REPLICAS)
+        closer = [peer_identifier for peer_identifier, _ in closest if peer_identifier ^ key < my_distance]
+
+        return len(closer) < config.SHARD_REPLICAS
+
+    @asyncio.coroutine
+    def shard_peers(self, account):
+        """
+        The nodes responsible for an account's shard.
+        """
+
+        try:
+            closest = yield from self.lookup_node(shard_key(account))
+        except KeyError:
+            closest = []
+
+        return [peer for _, peer in closest[:config.SHARD_REPLICAS]]
+
+    @asyncio.coroutine
+    def publish_commit(self, txs, digital_signature, pub_key):
+        """
+        Let the rest of the network know about a committed transaction.
+
+        In a sharded ledger only the shards of the sender (whose inputs got
+        spent) and receiver (who got a new output) need to know.
+        """
+
+        if not self.sharded:
+            yield from self.broadcast(random_id(), 'commit_tx', self.identifier, txs, digital_signature, pub_key)
+            return
+
+        sender_shard = set((yield from self.shard_peers(txs[0].sender)))
+        receiver_shard = set((yield from self.shard_peers(txs[0].receiver)))
+
+        # The receiver's shard verifies the inputs against the sender's,
+        # so it has to commit before the sender's shard marks them spent
+        for peers in (receiver_shard - sender_shard, sender_shard):
+            peers.discard(self.socket_addr)
+
+            yield from asyncio.gather(*[
+                self.quietly(self.commit_tx(peer, self.identifier, txs, digital_signature, pub_key))
+                for peer in sorted(peers)
+            ])
+
+    def open_wal(self, path):
+        """
+        Start logging to the write-ahead log at path, after replaying it.
+        """
+
+        self.wal = WriteAheadLog(path, config.WAL_GROUP_COMMIT_DELAY)
+        self.replay(self.wal.recovered)
+
+    @asyncio.coroutine
+    def write_ahead(self, *record):
+        """
+        Wait until record is durably in the write-ahead log (if we keep one.)
+        """
+
+        if self.wal is not None:
+            yield from self.wal.append(record)
+
+    def replay(self, records):
+        for kind, txs, *details in records:
+            if kind == 'prepare':
+                self.isbusy = (True, txs)
+
+            elif kind == 'commit':
+                if txs[0] not in self.ledger.record:
+                    self.apply_commit(txs, details[0])
+
+                if self.isbusy[1] == txs:
+                    self.isbusy = (False, None)
+
+            elif kind == 'abort':
+                self.rollback(txs)
+
+                if self.isbusy[1] == txs:
+                    self.isbusy = (False, None)
+
+        if records:
+            logger.info("Replayed %d records from the write-ahead log", len(records))
+
+        if self.isbusy[0] and self.isbusy[1][0] in self.ledger.record:
+            # Committed, the snapshot just has it busy still
+            self.isbusy = (False, None)
+
+        elif self.isbusy[0] and self.isbusy[1][0].sender != self.identifier:
+            # A prepare whose outcome I never heard of (as the sender,
+            # two_phase_protocol simply runs it again.) Its commit may
+            # still be on the way, if not I won't be stuck with it.
+            asyncio.get_event_loop().call_later(config.PREPARE_TIMEOUT, self.expire_prepare, self.isbusy[1])
+
+    def expire_prepare(self, txs):
+        if self.isbusy[1] == txs:
+            logger.warn("Giving up on the transaction %r", txs)
+            self.isbusy = (False, None)
+
+    def close_wal(self):
+        """
+        Stop logging (once everything in the log is in a snapshot.)
+        """
+
+        if self.wal is not None:
+            self.wal.close()
+            self.wal = None
+
+    def apply_commit(self, txs, inputs):
+        """
+        Spend inputs & add txs to the ledger, returns ids of the spent inputs.
+        """
+
+        spent = [getattr(tx, 'id', tx) for tx in inputs if self.ledger.spend(tx)]
+
+        for tx in txs:
+            self.ledger.add_tx(tx)
+
+        self.undo_log[txs[0].id] = spent
+        bounded(self.undo_log, config.UNDO_LOG_SIZE)
+
+        for callback in self.on_commit:
+            callback(self, txs)
+
+        return spent
+
+    def rollback(self, txs):
+        for tx in txs:
+            self.ledger.remove_tx(tx)
+
+        # Only the inputs that this very commit had marked spent
+        for tx_id in self.undo_log.pop(txs[0].id, []):
+            self.ledger.unspend(tx_id)
+
+        for callback in self.on_abort:
+            callback(self, txs)
+
+    def pending_ids(self, checkpoint):
+        """
+        Ids of the transactions a commit in progress (or a commit newer than
+        checkpoint, which may still be aborted) refers to - compacting up
+        to checkpoint must leave them alone.
+        """
+
+        ids = set(
+            tx_id for commit_id, spent in self.undo_log.items()
+            if commit_id >= checkpoint for tx_id in spent
+        )
+
+        if self.isbusy[0]:
+            for tx in self.isbusy[1]:
+                ids.add(tx.id)
+                ids.update(tx.input_ids())
+
+        return ids
+
+    def save_state(self, path):
+        super(Node, self).save_state(path)
+
+        # Everything logged so far is in the snapshot
+        if self.wal is not None:
+            self.wal.truncate()
+
+    def dump_state(self):
+        state = super(Node, self).dump_state()
+
+        state['ledger'] = self.ledger
+        state['isbusy'] = self.isbusy
+        state['undo_log'] = self.undo_log
+
+        return state
+
+    def restore_state(self, state):
+        super(Node, self).restore_state(state)
+
+        # A ledger saved by some other node (or kind of node) is of no use
+        ledger = state.get('ledger')
+        if state['identifier'] != self.identifier or type(ledger) is not type(self.ledger):
+            return
+
+        if self.sharded:
+            ledger.owns = self.owns_account
+
+        self.ledger = ledger
+        self.isbusy = state['isbusy']
+        self.undo_log = state['undo_log']
+
+    def stats(self):
+        stats = super(Node, self).stats()
+
+        stats['ledger'] = {
+            'transactions': len(self.ledger.record),
+            'archived': self.ledger.archived_count,
+            'busy': self.isbusy[0],
+            'wal_fsyncs': self.wal.fsyncs if self.wal is not None else None,
+        }
+
+        return stats
+
     def storage_str(self):
         dht = ""
         for k, v in self.storage.items():
@@ -50,27 +292,29 @@ class Node(KademliaNode):
 
     def broadcast_received(self, peer, message_identifier, procedure_name, *args):
         peer_identifier = args[0]
-        self.routing_table.update_peer(peer_identifier, peer)  # update the routing table
+        self.update_peer(peer_identifier, peer)  # update the routing table
+        self.mark_seen(peer, message_identifier)  # no need to send it back to where it came from
 
         # TODO: Move this to DatagramRPCProtocol?
         if message_identifier not in self.broadcast_list:  # if message identifier is not in list
             self.broadcast_list.append(message_identifier)  # append it to broadcast list
-            self.broadcast(message_identifier, procedure_name, *args)  # broadcast it to other peers
+            asyncio.ensure_future(self.broadcast(message_identifier, procedure_name, *args))  # broadcast it to other peers
             super(Node, self).broadcast_received(peer, message_identifier, procedure_name, *args)  # call super's broadcast received that will call the procedure_name
 
     def request_received(self, peer, message_identifier, procedure_name, args, kwargs):
         peer_identifier = args[0]
-        self.routing_table.update_peer(peer_identifier, peer)
+        self.update_peer(peer_identifier, peer)
 
         super(Node, self).request_received(peer, message_identifier, procedure_name, args, kwargs)
 
     def reply_received(self, peer, message_identifier, response):
         peer_identifier, response = response
-        self.routing_table.update_peer(peer_identifier, peer)
+        self.update_peer(peer_identifier, peer)
 
         super(Node, self).reply_received(peer, message_identifier, response)
 
     @rpc
+    @asyncio.coroutine
     def send_amount(self, peer_sock, peer_id, receiver_id, witness_id, amount):
         # This node is the sender
         # Caller is the node that initiated the call (can be sender itself or cli.py)
@@ -78,20 +322,32 @@ class Node(KademliaNode):
         trans_ok, txs = self.ledger.gen_trans(self.identifier, receiver_id, witness_id, amount)
 
         response = ""
-        if not trans_ok:
+        if self.syncing:
+            response = "Still syncing the ledger, try again later"
+        elif not trans_ok:
             response = "Not enough balance"
         elif self.isbusy[0]:
             response = "Node already busy in another tx %d" % (self.isbusy[1][0].id)
         else:
             self.isbusy = (True, txs)
+
+            for callback in self.on_prepare:
+                callback(self, txs)
+
+            yield from self.write_ahead('prepare', txs)
             response = "Initiating two phase commit Protocol from %d to %d using %d as witness." % (self.identifier, receiver_id, witness_id)
 
         return (self.identifier, response)
 
     @rpc
+    @asyncio.coroutine
     def become_receiver(self, peer_sock, peer_id, txs):
         logger.info("Handling request to become receiver for the transactions %r", txs)
 
+        if self.syncing:
+            logger.info("Cannot become receiver while syncing the ledger")
+            return (self.identifier, "busy")
+
         if self.isbusy[0] and self.isbusy[1] != txs:
             logger.info("Cannot become receiver already busy in another transaction")
             return (self.identifier, "busy")  # return busy
@@ -101,11 +357,18 @@ class Node(KademliaNode):
 
             # I'm now busy handling this tx
             self.isbusy = (True, txs)
+            yield from self.write_ahead('prepare', txs)
             return (self.identifier, "yes")  # return yes
 
     @rpc
+    @asyncio.coroutine
     def become_witness(self, peer_sock, peer_id, txs):
         logger.info("Handling request to become receiver for the transaction %r", txs)
+
+        if self.syncing:
+            logger.info("Cannot become witness while syncing the ledger")
+            return (self.identifier, "busy")
+
         if self.isbusy[0] and self.isbusy[1] != txs:  # check if node busy in other trans
             logger.info("Cannot become witness already busy in another tranasction")
             return (self.identifier, "busy")  # return busy
@@ -115,28 +378,224 @@ class Node(KademliaNode):
 
             # I'm now busy handling this tx
             self.isbusy = (True, txs)
+            yield from self.write_ahead('prepare', txs)
             return (self.identifier, "yes")  # return yes
 
     @rpc
+    @asyncio.coroutine
     def get_ledger(self, peer_sock, peer_id):
+        # A coroutine, so that large ledger transfers go through the
+        # dispatcher and don't get ahead of cheap requests like ping
         return (self.identifier, self.ledger)
 
+    @rpc
+    def get_ledger_info(self, peer_sock, peer_id):
+        # Number of transactions, the smallest & largest transaction id
+        # and what has been archived by compaction
+        record = self.ledger.record or [None]
+        first, last = getattr(record[0], 'id', 0), getattr(record[-1], 'id', 0)
+
+        archived = (self.ledger.checkpoint, self.ledger.archived_count, self.ledger.archived_root)
+
+        return (self.identifier, (len(self.ledger.record), first, last, archived))
+
+    @rpc
+    @asyncio.coroutine
+    def get_ledger_range(self, peer_sock, peer_id, start, end):
+        if self.light:
+            return (self.identifier, None)
+
+        return (self.identifier, self.ledger.range(start, end))
+
+    @rpc
+    def get_transactions(self, peer_sock, peer_id, tx_ids):
+        # Light nodes can't vouch for transactions they don't keep
+        if self.light:
+            return (self.identifier, None)
+
+        found = [self.ledger.find(tx_id) for tx_id in tx_ids]
+        return (self.identifier, [tx for tx in found if tx is not None])
+
+    @rpc
+    def get_account(self, peer_sock, peer_id, account):
+        if self.light and account != self.identifier:
+            return (self.identifier, None)
+
+        return (self.identifier, self.ledger.touching(account))
+
+    @asyncio.coroutine
+    def fetch_inputs(self, txs, tx_ids):
+        """
+        Ask a few peers for the input transactions I don't have.
+
+        These are my closest (full) peers for light nodes and the sender's
+        shard for sharded ones. An input is only trusted if most of the
+        nodes that have it agree that it is unspent.
+        """
+
+        if self.sharded:
+            peers = yield from self.shard_peers(txs[0].sender)
+        else:
+            peers = [peer for _, peer in self.routing_table.find_closest_peers(
+                self.identifier, k=config.LIGHT_PROOF_PEERS)]
+
+        responses = yield from asyncio.gather(*[
+            self.get_transactions(peer, self.identifier, tx_ids)
+            for peer in peers
+        ], return_exceptions=True)
+
+        responses = [r for r in responses if isinstance(r, list)]
+
+        inputs = {}
+        for tx_id in tx_ids:
+            copies = [tx for r in responses for tx in r if tx.id == tx_id]
+            unspent = [tx for tx in copies if not tx.spent]
+
+            if 2 * len(unspent) > len(copies):
+                inputs[tx_id] = unspent[0]
+
+        return inputs
+
+    @asyncio.coroutine
+    def sync_ledger(self, known_node):
+        """
+        Catch up on the ledger by downloading disjoint id ranges of it in
+        parallel from my closest peers (the ones that are atleast as far
+        along as known_node), and merge them into my ledger.
+
+        Returns False if known_node couldn't tell me how far the ledger goes.
+        """
+
+        if self.light:
+            # Just my own transactions (if I'm an identity that's been around)
+            mine = yield from self.quietly(self.get_account(known_node, self.identifier, self.identifier))
+            self.ledger.merge(mine or [])
+            return mine is not None
+
+        info = yield from self.quietly(self.get_ledger_info(known_node, self.identifier))
+        if info is None:
+            logger.warn("Could not get ledger info from %r", known_node)
+            return False
+
+        count, first, last, archived = info
+
+        candidates = [
+            peer for _, peer in
+            self.routing_table.find_closest_peers(self.identifier, k=config.LEDGER_SYNC_PEERS)
+            if peer != known_node
+        ]
+
+        infos = yield from asyncio.gather(*[
+            self.quietly(self.get_ledger_info(peer, self.identifier))
+            for peer in candidates
+        ])
+
+        peers = []
+        for peer, peer_info in zip(candidates, infos):
+            if peer_info is None:
+                continue
+
+            peer_count, _, peer_last, peer_archived = peer_info
+
+            # Peers that are behind (say, still syncing themselves) would hand
+            # out holes - in a sharded ledger counts differ, the last id doesn't
+            if peer_last < last or (peer_count < count and not self.sharded):
+                continue
+
+            # Peers that have archived more (or less) than known_node would
+            # leave out (or add) transactions that its header doesn't cover
+            # - in a sharded ledger only the checkpoints are comparable
+            if peer_archived[0] != archived[0] or (peer_archived != archived and not self.sharded):
+                continue
+
+            peers.append(peer)
+
+        fallback = [known_node] if peers else []
+        peers = peers or [known_node]
+
+        if self.sharded:
+            # Every peer only has its own shard, so ask each of them for
+            # everything - the ones close to me share most of my shard
+            ranges = [(first, last + 1)] * len(peers)
+        else:
+            # Split [first, last] into one range per peer
+            step = (last + 1 - first) // len(peers) + 1
+            ranges = [(start, min(start + step, last + 1)) for start in range(first, last + 1, step)]
+
+        # A range that fails (or comes back invalid) is asked
+        # of the next peer, and then of known_node
+        chunks = yield from asyncio.gather(*[
+            self.fetch_range(peers[i:] + peers[:i] + fallback, start, end)
+            for i, (start, end) in enumerate(ranges)
+        ])
+
+        record = {}
+        for chunk in chunks:
+            record.update((tx.id, tx) for tx in chunk or [])
+
+        record = [record[tx_id] for tx_id in sorted(record)]
+
+        if len(record) < count and not self.sharded:
+            logger.warn("Got %d of %d transactions, fetching the whole ledger", len(record), count)
+            ledger = yield from self.quietly(self.get_ledger(known_node, self.identifier))
+            if ledger is not None:
+                record = ledger.record
+
+        added = self.ledger.merge(record)
+        logger.info("Got Ledger of %d transactions (%d of them new)", len(record), added)
+
+        # Whatever the known node has archived is history for me too
+        if archived[0] > self.ledger.checkpoint:
+            self.ledger.checkpoint, self.ledger.archived_count, self.ledger.archived_root = archived
+
+        return True
+
+    @asyncio.coroutine
+    def fetch_range(self, sources, start, end):
+        """
+        Transactions with start <= id < end, from the first of sources that
+        has any of them (None if none of them answered properly.)
+        """
+
+        found = None
+
+        for peer in sources:
+            chunk = yield from self.quietly(self.get_ledger_range(peer, self.identifier, start, end))
+
+            if chunk is not None and valid_range(chunk, start, end):
+                if chunk:
+                    return chunk
+
+                # Could just be a gap in the ids, but could also be
+                # a peer that lost (or never got) those transactions
+                found = chunk
+
+            logger.info("Could not fetch ledger range [%d, %d) from %r", start, end, peer)
+
+        return found
+
     @rpc
     def print_ledger(self, peer_sock, peer_id):
         print(self.ledger)
         return (self.identifier, True)
 
     @rpc
+    @asyncio.coroutine
     def add_tx_to_ledger(self, peer, peer_id, tx):
-        self.ledger.add_tx(tx)
+        yield from self.write_ahead('commit', [tx], [])
+        self.apply_commit([tx], [])
         logger.info("Added transaction %r to the ledger", tx)
         return (self.identifier, True)
 
     @rpc
+    @asyncio.coroutine
     def commit_tx(self, peer, peer_id, txs, digital_signature, pub_key, *args):
 
+        # Signature verification is the expensive bit,
+        # so run it outside of the event loop's thread
         logger.info("Verifying Digital Signature %r", txs)
-        signature_matches = verify_msg(pub_key, repr(txs), digital_signature)
+        signature_matches = yield from self.profiler.run_in_executor(
+            verify_msg, pub_key, repr(txs), digital_signature)
 
         if signature_matches:
             logger.info("Digital Signature verification successfull")
@@ -147,28 +606,56 @@ class Node(KademliaNode):
                 tx_type = "old"
 
             # Is someone trying to game the system?
-            if(tx_type == "old" and len(txs) == 2 and txs[1] not in self.ledger.record):
+            if(tx_type == "old" and len(txs) == 2 and txs[1] not in self.ledger.record and self.ledger.keeps(txs[1])):
                 tx_type = "weird"
 
+            involved = self.identifier in [txs[0].sender, txs[0].receiver, txs[0].witness]
+
+            # Light nodes just note down the header of other people's transactions
+            if tx_type == "new" and self.light and not involved:
+                yield from self.write_ahead('commit', txs, [])
+                self.apply_commit(txs, [])
+
+                return (self.identifier, "committed")
+
             if tx_type == "new":
                 logger.info("Verifying Transaction %r", txs)
 
-                if self.ledger.verify_trans(txs):
+                # Light & sharded nodes need proof of inputs they've never seen
+                inputs = None
+                missing = self.ledger.missing_inputs(txs)
+                if (self.light or self.sharded) and missing:
+                    inputs = yield from self.fetch_inputs(txs, missing)
+
+                    # Someone committed it while we were waiting
+                    if txs[0] in self.ledger.record:
+                        return (self.identifier, "committed")
+
+                if self.ledger.verify_trans(txs, inputs):
                     logger.info("Transaction successfully verified")
 
-                    # Mark each of the inputs as spent
-                    for tx in txs[0].input_tx:
-                        self.ledger[self.ledger.index(tx)].spent = True
+                    # Don't touch the ledger (or acknowledge the commit) until it's
+                    # durable - replaying it only spends inputs that aren't already
+                    yield from self.write_ahead('commit', txs, txs[0].input_ids())
+
+                    # Someone committed it while it was being written
+                    if txs[0] in self.ledger.record:
+                        return (self.identifier, "committed")
+
+                    # ...or spent one of its inputs
+                    if not self.ledger.verify_trans(txs, inputs):
+                        logger.warn("Inputs spent while committing %r", txs)
+                        yield from self.write_ahead('abort', txs)
 
-                    # Add theses transactions to my ledger
-                    for tx in txs:
-                        self.ledger.add_tx(tx)
-                        logger.info("Added transaction %d to the ledger", tx.id)
+                        return (self.identifier, "abort")
+
+                    # Mark each of the inputs as spent & add these transactions to my ledger
+                    self.apply_commit(txs, txs[0].input_tx)
 
                     logger.info("Transaction successfully committed %r", txs)
 
                     # I am now free from handling this transaction
-                    if(self.identifier in [txs[0].sender, txs[0].receiver, txs[0].witness]):
+                    if involved:
                         self.isbusy = (False, None)
 
                     return (self.identifier, "committed")
@@ -183,22 +670,20 @@ class Node(KademliaNode):
                 return (self.identifier, "committed")
 
             else:
-                logger.info("Weird transaction %d", tx[0].id)
+                logger.info("Weird transaction %d", txs[0].id)
                 return (self.identifier, "abort")
         else:
             logger.info("Digital Signature Verification Failed!")
             return (self.identifier, "abort")
 
     @rpc
+    @asyncio.coroutine
     def abort_tx(self, peer, peer_id, txs):
 
-        for tx in txs:
-            if tx in self.ledger.record:
-                self.ledger.record.remove(tx)
-
-        # TODO: Revert the 'spent' field of input transactions
-        # (but only if it was changed)
-        # This requires some kind of an undo log
+        # Remove the transactions & revert the 'spent' field of
+        # input transactions (but only if this commit changed it)
+        yield from self.write_ahead('abort', txs)
+        self.rollback(txs)
 
         if self.isbusy[0] and self.isbusy[1] == txs:
             self.isbusy = (False, None)
@@ -207,3 +692,16 @@ class Node(KademliaNode):
             return (self.identifier, "aborted")
 
         return (self.identifier, "Not involved in this transaction")
+
+
+def valid_range(chunk, start, end):
+    """
+    Is chunk a list of transactions sorted by (unique) id, all in [start, end)?
+    """
+
+    try:
+        ids = [tx.id for tx in chunk]
+    except (TypeError, AttributeError):
+        return False
+
+    return all(start <= i < end for i in ids) and ids == sorted(set(ids))
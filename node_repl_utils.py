@@ -1,6 +1,8 @@
 import re
+import os
 import ast
 from collections import OrderedDict
+from functools import lru_cache
 
 import config
 
@@ -19,10 +21,12 @@ def get_sock_from_name(name):
 
 # NOTE: Ideally, we should be using a better REPL module (like cmd.Cmd)
 
+# Only built (once) when help is first asked for, not on every start
+@lru_cache(maxsize=None)
 def generate_help_dict():
     # Get an Abstract Syntax Tree of the cli.py source file
     # I shall rot in seven hells for this sorcery
-    with open('start_node_repl.py') as src_file:
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'start_node_repl.py')) as src_file:
         tree = ast.parse(src_file.read())
 
     # Our goal is to build a dictionary of commands and their help strings
@@ -54,3 +58,84 @@ def generate_help_dict():
             commands[cmd] = docstring
 
     return commands
+
+
+def format_stats(stats):
+    """
+    A table of per procedure metrics from a node's stats().
+    """
+
+    counters = stats['metrics']['counters']
+    rtts = stats['metrics']['histograms'].get('rtt_seconds', {})
+
+    columns = ['requests_sent', 'requests_received', 'broadcasts_received', 'timeouts', 'busy_received', 'bytes_in', 'bytes_out']
+    procedures = sorted(set(p for name in columns for p in counters.get(name, {})) | set(rtts))
+
+    lines = ["%-20s" % "procedure" + "".join("%20s" % c for c in columns) + "%20s" % "mean_rtt_ms"]
+
+    for procedure in procedures:
+        line = "%-20s" % procedure
+        line += "".join("%20d" % counters.get(c, {}).get(procedure, 0) for c in columns)
+
+        rtt = rtts.get(procedure)
+        line += "%20.2f" % (1000 * rtt['sum'] / rtt['count']) if rtt else "%20s" % "-"
+
+        lines.append(line)
+
+    for name, histograms in sorted(stats['metrics']['histograms'].items()):
+        if name.startswith('lookup_'):
+            for kind, histogram in sorted(histograms.items()):
+                lines.append("%s %s: %d lookups, %.1f on average" % (
+                    kind, name, histogram['count'], histogram['sum'] / histogram['count']))
+
+    lines.append("peers: %d, pending handlers: %d" % (stats['peers'], stats['pending_handlers']))
+    lines.append("storage: %r" % stats['storage'])
+
+    if 'ledger' in stats:
+        lines.append("ledger: %r" % stats['ledger'])
+
+    return "\n".join(lines)
+
+
+def format_cluster_stats(cluster):
+    """
+    A table with a row per node from Node.cluster_stats(), laggards marked.
+    """
+
+    def total(stats, name):
+        return sum(stats['metrics']['counters'].get(name, {}).values())
+
+    def mean_rtt(stats):
+        rtts = stats['metrics']['histograms'].get('rtt_seconds', {}).values()
+        count = sum(h['count'] for h in rtts)
+        return 1000 * sum(h['sum'] for h in rtts) / count if count else 0
+
+    alive = {peer: stats for peer, stats in cluster.items() if stats is not None}
+    longest = max((s.get('ledger', {}).get('transactions', 0) for s in alive.values()), default=0)
+
+    columns = ("address", "ledger", "peers", "dht_keys", "busy", "in_flight", "sent", "received", "timeouts", "rtt_ms")
+    lines = ["%-22s%8s%8s%10s%6s%11s%10s%10s%10s%10s" % columns]
+
+    for peer, stats in sorted(alive.items(), key=lambda item: str(item[0])):
+        ledger = stats.get('ledger', {})
+        transactions = ledger.get('transactions', 0)
+
+        lines.append("%-22s%8d%8d%10d%6s%11d%10d%10d%10d%10.1f%s" % (
+            "%s:%d" % tuple(peer),
+            transactions,
+            stats['peers'],
+            stats['storage']['keys'],
+            "yes" if ledger.get('busy') else "no",
+            stats['pending_handlers'] + stats['outstanding_requests'],
+            total(stats, 'requests_sent'),
+            total(stats, 'requests_received'),
+            total(stats, 'timeouts'),
+            mean_rtt(stats),
+            "  <- lagging" if transactions < longest else "",
+        ))
+
+    dead = sorted(str(peer) for peer, stats in cluster.items() if stats is None)
+
+    lines.append("%d nodes answered, %d didn't%s" % (len(alive), len(dead), (": " + ", ".join(dead)) if dead else ""))
+
+    return "\n".join(lines)
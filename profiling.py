@@ -0,0 +1,259 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+from collections import deque
+
+import config
+
+logger = logging.getLogger('node.rpc')
+
+# cProfile, tracemalloc and asyncio's debug mode are process (or loop)
+# wide, so only one Profiler at a time may turn each of them on:
+# 'cpu', 'mem' or 'lag' => the Profiler that did
+owners = {}
+
+
+class SlowCallbackHandler(logging.Handler):
+
+    """
+    Catches asyncio's (debug mode) warnings about slow callbacks.
+    """
+
+    def __init__(self, profiler):
+        super(SlowCallbackHandler, self).__init__()
+        self.profiler = profiler
+
+    def emit(self, record):
+        # asyncio logs these as "Executing %s took %.3f seconds"
+        if isinstance(record.msg, str) and record.msg.startswith('Executing') and len(record.args) == 2:
+            handle, seconds = record.args
+            self.profiler.slow_callback(repr(handle), seconds)
+
+
+class Profiler(object):
+
+    """
+    Runtime switchable CPU & memory profiling, and event loop lag monitoring.
+
+    Everything is written to config.LOG_DIR. Every action returns a short
+    text summary, so it can be shown in the REPL or sent back over an RPC.
+    """
+
+    def __init__(self, protocol):
+
+        # The DatagramRPCProtocol (node) being profiled
+        self.protocol = protocol
+
+        # cProfile.Profile of the event loop's thread, while profiling
+        self.cpu = None
+
+        # Profiles of functions run in the executor, while profiling
+        self.thread_profiles = []
+        self.thread_profiles_lock = threading.Lock()
+
+        self.lag_task = None
+        self.asyncio_handler = None
+
+        # (time, what, seconds) of the most recent slow callbacks & handlers
+        self.slow = deque(maxlen=config.PROFILE_SLOW_EVENTS)
+
+    def name(self):
+        return getattr(self.protocol, 'identifier', None) or '%s_%d' % self.protocol.socket_addr
+
+    def path(self, kind, extension):
+        if not os.path.exists(config.LOG_DIR):
+            os.mkdir(config.LOG_DIR)
+
+        return os.path.join(config.LOG_DIR, "%s.%s.%d.%s" % (self.name(), kind, time.time(), extension))
+
+    def owned_by_other(self, kind):
+        """
+        Is kind (of profiling) on for another node in this process?
+        """
+
+        return owners.get(kind, self) is not self
+
+    def command(self, action):
+        """
+        Run one of the actions below by name, e.g. "cpu_start".
+        """
+
+        actions = {
+            'cpu_start': self.start_cpu,
+            'cpu_stop': self.stop_cpu,
+            'mem_start': self.start_memory,
+            'mem_snapshot': self.snapshot_memory,
+            'mem_stop': self.stop_memory,
+            'lag_start': self.start_lag,
+            'lag_stop': self.stop_lag,
+        }
+
+        if action not in actions:
+            return "Unknown action %r, expected one of: %s" % (action, ", ".join(sorted(actions)))
+
+        return actions[action]()
+
+    def start_cpu(self):
+        if self.owned_by_other('cpu'):
+            return "CPU profiling is on for %s (in the same process)" % owners['cpu'].name()
+
+        if self.cpu is not None:
+            return "CPU profiling is already on"
+
+        self.thread_profiles = []
+        self.cpu = cProfile.Profile()
+        self.cpu.enable()
+        owners['cpu'] = self
+
+        return "CPU profiling started"
+
+    def stop_cpu(self):
+        if self.cpu is None:
+            return "CPU profiling is off"
+
+        self.cpu.disable()
+        del owners['cpu']
+
+        stats = pstats.Stats(self.cpu)
+        with self.thread_profiles_lock:
+            for profile in self.thread_profiles:
+                stats.add(profile)
+
+        self.cpu, self.thread_profiles = None, []
+
+        path = self.path('cpu', 'pstats')
+        stats.dump_stats(path)
+
+        summary = io.StringIO()
+        stats.stream = summary
+        stats.sort_stats('cumulative').print_stats(config.PROFILE_TOP)
+
+        return "Wrote %s\n%s" % (path, summary.getvalue())
+
+    def run_in_executor(self, func, *args):
+        """
+        loop.run_in_executor, but profiled too while CPU profiling is on.
+        """
+
+        if self.cpu is None:
+            return asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+        def profiled():
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(func, *args)
+            finally:
+                with self.thread_profiles_lock:
+                    self.thread_profiles.append(profile)
+
+        return asyncio.get_event_loop().run_in_executor(None, profiled)
+
+    def start_memory(self):
+        if self.owned_by_other('mem'):
+            return "Memory tracing is on for %s (in the same process)" % owners['mem'].name()
+
+        if tracemalloc.is_tracing():
+            return "Memory tracing is already on"
+
+        tracemalloc.start(config.PROFILE_FRAMES)
+        owners['mem'] = self
+
+        return "Memory tracing started"
+
+    def snapshot_memory(self):
+        if self.owned_by_other('mem'):
+            return "Memory tracing is on for %s (in the same process)" % owners['mem'].name()
+
+        if not tracemalloc.is_tracing():
+            return "Memory tracing is off"
+
+        snapshot = tracemalloc.take_snapshot()
+
+        path = self.path('mem', 'tracemalloc')
+        snapshot.dump(path)
+
+        lines = ["Wrote %s" % path]
+        for stat in snapshot.statistics('lineno')[:config.PROFILE_TOP]:
+            lines.append(str(stat))
+
+        return "\n".join(lines)
+
+    def stop_memory(self):
+        if self.owned_by_other('mem'):
+            return "Memory tracing is on for %s (in the same process)" % owners['mem'].name()
+
+        if not tracemalloc.is_tracing():
+            return "Memory tracing is off"
+
+        summary = self.snapshot_memory()
+        tracemalloc.stop()
+        owners.pop('mem', None)
+
+        return summary
+
+    def start_lag(self):
+        if self.owned_by_other('lag'):
+            return "Loop lag monitoring is on for %s (in the same process)" % owners['lag'].name()
+
+        if self.lag_task is not None:
+            return "Loop lag monitoring is already on"
+
+        loop = asyncio.get_event_loop()
+
+        # asyncio's debug mode times every callback, so it's only on while monitoring
+        loop.set_debug(True)
+        loop.slow_callback_duration = config.SLOW_CALLBACK_THRESHOLD
+
+        self.asyncio_handler = SlowCallbackHandler(self)
+        logging.getLogger('asyncio').addHandler(self.asyncio_handler)
+
+        self.lag_task = asyncio.ensure_future(self.monitor_lag())
+        owners['lag'] = self
+
+        return "Loop lag monitoring started"
+
+    def stop_lag(self):
+        if self.lag_task is None:
+            return "Loop lag monitoring is off"
+
+        self.lag_task.cancel()
+        self.lag_task = None
+        del owners['lag']
+
+        asyncio.get_event_loop().set_debug(False)
+        logging.getLogger('asyncio').removeHandler(self.asyncio_handler)
+        self.asyncio_handler = None
+
+        lines = ["%s %.3fs %s" % (time.strftime('%H:%M:%S', time.localtime(when)), seconds, what)
+                 for when, what, seconds in self.slow]
+
+        path = self.path('lag', 'txt')
+        with open(path, 'w') as f:
+            f.write("\n".join(lines) + "\n")
+
+        return "Wrote %s\n%s" % (path, "\n".join(lines[-config.PROFILE_TOP:]))
+
+    @asyncio.coroutine
+    def monitor_lag(self, interval=config.LOOP_LAG_INTERVAL):
+        loop = asyncio.get_event_loop()
+
+        while True:
+            expected = loop.time() + interval
+            yield from asyncio.sleep(interval)
+
+            lag = loop.time() - expected
+            self.protocol.metrics.observe('loop_lag_seconds', 'loop', lag)
+
+            if lag > config.SLOW_CALLBACK_THRESHOLD:
+                self.slow_callback("loop lag, last handled %r" % self.protocol.last_procedure, lag)
+
+    def slow_callback(self, what, seconds):
+        logger.warning("Slow callback (%.3fs): %s", seconds, what)
+        self.slow.append((time.time(), what, seconds))
@@ -1,6 +1,124 @@
+import random
+
 from collections import OrderedDict
 
-from itertools import zip_longest
+
+class PeerTrie(object):
+    """
+    A binary trie over 160 bit identifiers.
+
+    Walking it while preferring the branch that matches the key's bit at each
+    level visits the peers in increasing order of XOR distance from the key.
+    """
+
+    def __init__(self):
+
+        # Internal nodes are [child_0, child_1] lists, leaves are
+        # (identifier, peer) tuples - a subtree with a single peer is
+        # just its leaf, so paths are only as deep as they need to be
+        self.root = [None, None]
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def insert(self, identifier, peer):
+        node = self.root
+        shift = 159
+
+        while True:
+            bit = (identifier >> shift) & 1
+            child = node[bit]
+
+            if child is None:
+                node[bit] = (identifier, peer)
+                self.size += 1
+                return
+
+            if isinstance(child, tuple):
+                break
+
+            node = child
+            shift -= 1
+
+        if child[0] == identifier:
+            node[bit] = (identifier, peer)
+            return
+
+        # Split the leaf until the two identifiers go different ways
+        while True:
+            shift -= 1
+
+            node[bit] = [None, None]
+            node = node[bit]
+
+            bit = (identifier >> shift) & 1
+            other_bit = (child[0] >> shift) & 1
+
+            if bit != other_bit:
+                node[bit] = (identifier, peer)
+                node[other_bit] = child
+                self.size += 1
+                return
+
+    def remove(self, identifier):
+        path = []
+        node = self.root
+        shift = 159
+
+        while True:
+            bit = (identifier >> shift) & 1
+            child = node[bit]
+
+            if child is None:
+                return
+
+            if isinstance(child, tuple):
+                break
+
+            path.append((node, bit))
+            node = child
+            shift -= 1
+
+        if child[0] != identifier:
+            return
+
+        node[bit] = None
+        self.size -= 1
+
+        # Prune internal nodes that no longer lead anywhere,
+        # and replace the ones left with a single leaf by that leaf
+        while path:
+            children = [child for child in node if child is not None]
+
+            if len(children) > 1 or (children and not isinstance(children[0], tuple)):
+                break
+
+            parent, bit = path.pop()
+            parent[bit] = children[0] if children else None
+            node = parent
+
+    def closest(self, key):
+        """
+        Generate (identifier, peer) tuples sorted by their distance from key.
+        """
+
+        stack = [(self.root, 159)]
+
+        while stack:
+            node, shift = stack.pop()
+
+            # The only peer in its subtree
+            if isinstance(node, tuple):
+                yield node
+                continue
+
+            near = (key >> shift) & 1
+
+            # Push the far branch first, so that the near one is popped first
+            for bit in (1 - near, near):
+                if node[bit] is not None:
+                    stack.append((node[bit], shift - 1))
 
 
 class RoutingTable(object):
@@ -12,6 +130,12 @@ class RoutingTable(object):
         self.buckets = [OrderedDict() for _ in range(161)] #
         self.replacement_caches = [OrderedDict() for _ in range(161)] #
 
+        # When was each bucket last involved in a lookup
+        self.last_lookup = [0] * 161
+
+        # Every peer in the buckets (not the replacement caches) indexed by id
+        self.index = PeerTrie()
+
         super(RoutingTable, self).__init__()
 
     def __str__(self):
@@ -38,6 +162,13 @@ class RoutingTable(object):
         return 160 - self.distance(peer_identifier).bit_length()
 
     def update_peer(self, peer_identifier, peer):
+        """
+        Record that we've heard from a peer.
+
+        If the peer's bucket is full, the peer goes into the replacement
+        cache and the least recently seen peer of that bucket is returned,
+        so that the caller can check whether it's still alive.
+        """
 
         if peer_identifier == self.node_identifier:
             return
@@ -48,9 +179,11 @@ class RoutingTable(object):
         if peer_identifier in bucket:
             del bucket[peer_identifier]
             bucket[peer_identifier] = peer
+            self.index.insert(peer_identifier, peer)
 
         elif len(bucket) < self.k:
             bucket[peer_identifier] = peer
+            self.index.insert(peer_identifier, peer)
 
         else:
             replacement_cache = self.replacement_caches[bucket_index]
@@ -60,6 +193,8 @@ class RoutingTable(object):
 
             replacement_cache[peer_identifier] = peer
 
+            return next(iter(bucket.items()))
+
     def forget_peer(self, peer_identifier):
 
         if peer_identifier == self.node_identifier:
@@ -71,34 +206,84 @@ class RoutingTable(object):
 
         if peer_identifier in bucket:
             del bucket[peer_identifier]
+            self.index.remove(peer_identifier)
 
             if len(replacement_cache):
                 replacement_identifier, replacement_peer = replacement_cache.popitem()
                 bucket[replacement_identifier] = replacement_peer
+                self.index.insert(replacement_identifier, replacement_peer)
+
+    def snapshot(self):
+        """
+        A picklable copy of the buckets & replacement caches.
+        """
+
+        return {
+            'buckets': [list(bucket.items()) for bucket in self.buckets],
+            'replacement_caches': [list(cache.items()) for cache in self.replacement_caches],
+        }
+
+    def restore(self, snapshot):
+        """
+        Load peers from a snapshot (which may have been taken under another id.)
+        """
+
+        for bucket in snapshot['buckets']:
+            for peer_identifier, peer in bucket:
+                self.update_peer(peer_identifier, peer)
+
+        for cache in snapshot['replacement_caches']:
+            for peer_identifier, peer in cache:
+                if peer_identifier == self.node_identifier:
+                    continue
 
-    def find_closest_peers(self, key, excluding=None, k=None):
-        peers = []
-        k = k or self.k
+                bucket_index = self.bucket_index(peer_identifier)
+                if peer_identifier not in self.buckets[bucket_index]:
+                    self.replacement_caches[bucket_index][peer_identifier] = peer
 
-        farther = range(self.bucket_index(key), -1, -1)
-        closer = range(self.bucket_index(key) + 1, 160, 1)
+    def touch_bucket(self, key, now):
+        self.last_lookup[self.bucket_index(key)] = now
 
-        for f, c in zip_longest(farther, closer):
+    def stale_buckets(self, now, interval):
+        """
+        Indices of buckets in range that haven't been looked up since interval.
+        """
 
-            for i in (f, c):
+        in_range = [i for i, bucket in enumerate(self.buckets[:160]) if bucket]
+        if not in_range:
+            return []
 
-                if i is None:
-                    continue
+        return [
+            i for i in range(max(in_range) + 1)
+            if now - self.last_lookup[i] >= interval
+        ]
+
+    def random_id_in_bucket(self, index):
+        """
+        A random identifier whose distance from us puts it into bucket index.
+        """
+
+        bits = 160 - index
+        distance = random.randrange(2 ** (bits - 1), 2 ** bits)
+
+        return self.node_identifier ^ distance
+
+    def find_closest_peers(self, key, excluding=None, k=None):
+        """
+        The k peers closest to key, sorted by their distance from it.
+        """
+
+        peers = []
+        k = k or self.k
 
-                bucket = self.buckets[i]
+        for peer_identifier, peer in self.index.closest(key):
 
-                for peer_identifier in reversed(bucket):
+            if peer_identifier == excluding:
+                continue
 
-                    if peer_identifier == excluding:
-                        continue
+            peers.append((peer_identifier, peer))
 
-                    peers.append((peer_identifier, bucket[peer_identifier]))
+            if len(peers) == k:
+                break
 
-                    if len(peers) == k:
-                        return peers
         return peers
@@ -2,12 +2,43 @@ import asyncio
 import pickle
 import logging
 import socket
+import struct
+import time
 
+from collections import OrderedDict, deque
 from functools import wraps
 
-from utils import random_id
+import config
 
-logger = logging.getLogger(__name__)
+from metrics import Metrics
+from profiling import Profiler
+from tracing import MessageLog, Short
+from utils import random_id, bounded
+
+logger = logging.getLogger('node.rpc')
+
+# Per message logs, sampled
+trace = MessageLog(logger)
+
+# Prefix of a datagram that packs several messages
+# (a protocol 0 pickle can never start with this)
+BATCH_MAGIC = b'#batch\n'
+
+# Each message in a batch is preceded by its length
+FRAME_HEADER = struct.Struct('!I')
+
+
+class RPCBusy(Exception):
+    """
+    Raised when the remote node was too busy to handle our request.
+    """
+
+
+class RPCError(RPCBusy):
+    """
+    Raised when the remote node's handler failed. Like RPCBusy, the node
+    is alive but couldn't help, so whoever catches that catches this too.
+    """
 
 
 def rpc(func):
@@ -18,6 +49,7 @@ def rpc(func):
     node.identifier as the first argument.
 
     All @rpc methods return a 2-tuple: (node_identifier, response)
+    (or are coroutines that eventually return one.)
 
     The node_identifier is consumed by kademlia to update its tables,
     while the response is sent as a reply back to the caller.
@@ -38,6 +70,99 @@ def rpc(func):
     return inner
 
 
+class Dispatcher(object):
+    """
+    Runs coroutine RPC handlers with a bound on how many may be pending
+    overall, and on how many of each procedure may run concurrently.
+    """
+
+    def __init__(self, queue_size, concurrency, limits=None):
+
+        self.queue_size = queue_size
+        self.concurrency = concurrency
+        self.limits = limits or {}
+
+        # Number of handlers that are either waiting or running
+        self.pending = 0
+
+        # procedure_name => asyncio.Semaphore
+        self.semaphores = {}
+
+    def semaphore(self, procedure_name):
+        if procedure_name not in self.semaphores:
+            limit = self.limits.get(procedure_name, self.concurrency)
+            self.semaphores[procedure_name] = asyncio.Semaphore(limit)
+
+        return self.semaphores[procedure_name]
+
+    def submit(self, procedure_name, coro, callback=None):
+        """
+        Schedule coro, returns False if we're overloaded and shed it instead.
+        """
+
+        if self.pending >= self.queue_size:
+            coro.close()
+            return False
+
+        self.pending += 1
+
+        task = asyncio.ensure_future(self.run(procedure_name, coro))
+        if callback:
+            task.add_done_callback(callback)
+
+        return True
+
+    @asyncio.coroutine
+    def run(self, procedure_name, coro):
+        semaphore = self.semaphore(procedure_name)
+
+        try:
+            yield from semaphore.acquire()
+            try:
+                return (yield from coro)
+            finally:
+                semaphore.release()
+        finally:
+            self.pending -= 1
+
+
+class RateLimiter(object):
+    """
+    A token bucket per source address.
+    """
+
+    def __init__(self, rate, burst, max_peers=4096):
+
+        self.rate = rate
+        self.burst = burst
+        self.max_peers = max_peers
+
+        # peer => [tokens, time of last refill]
+        self.buckets = OrderedDict()
+
+    def allow(self, peer):
+        now = asyncio.get_event_loop().time()
+
+        if peer in self.buckets:
+            bucket = self.buckets.pop(peer)
+        else:
+            bucket = [self.burst, now]
+
+        # Most recently heard from peers are kept at the end
+        self.buckets[peer] = bucket
+        bounded(self.buckets, self.max_peers)
+
+        tokens, last = bucket
+        tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+        if tokens < 1:
+            bucket[:] = [tokens, now]
+            return False
+
+        bucket[:] = [tokens - 1, now]
+        return True
+
+
 class DatagramRPCProtocol(asyncio.DatagramProtocol):
 
     def __init__(self, reply_timeout=5):
@@ -46,6 +171,42 @@ class DatagramRPCProtocol(asyncio.DatagramProtocol):
 
         self.outstanding_requests = {}
 
+        # message_identifier => (procedure_name, time it was sent)
+        # of our outstanding requests
+        self.request_info = {}
+
+        self.metrics = Metrics()
+        self.profiler = Profiler(self)
+
+        # Procedure of the last message handled (to blame for loop lag)
+        self.last_procedure = None
+
+        # Handlers that are coroutines are run through this
+        self.dispatcher = Dispatcher(
+            config.DISPATCH_QUEUE_SIZE,
+            config.DISPATCH_CONCURRENCY,
+            config.DISPATCH_LIMITS
+        )
+
+        # Outgoing messages waiting to be coalesced, per peer
+        # peer => list of pickled messages
+        self.coalesce = config.COALESCE_DATAGRAMS
+        self.send_queues = OrderedDict()
+        self.flush_scheduled = False
+
+        # Framed size of each peer's queued messages (so far)
+        # peer => bytes
+        self.queued_bytes = {}
+
+        # Inbound messages waiting to be handled, lane 0 goes first
+        # Each entry is a (message, peer) tuple
+        self.rate_limiter = RateLimiter(config.RATE_LIMIT, config.RATE_LIMIT_BURST)
+        self.inbound_lanes = [
+            deque(maxlen=config.INBOUND_LANE_SIZE)
+            for _ in range(max(config.PRIORITY_LANES.values(), default=0) + 1)
+        ]
+        self.drain_scheduled = False
+
         super(DatagramRPCProtocol, self).__init__()
 
     def connection_made(self, transport):
@@ -55,8 +216,119 @@ class DatagramRPCProtocol(asyncio.DatagramProtocol):
         self.socket_addr = self.transport.get_extra_info('sockname')
 
     def datagram_received(self, data, peer):
-        logger.info('data_received: %r, %r', peer, data)
-        msg_type, message_identifier, *details = pickle.loads(data)
+        if data.startswith(BATCH_MAGIC):
+            for message in unbatch(data):
+                self.datagram_received(message, peer)
+            return
+
+        trace('data_received: %r, %r', peer, data)
+        message = pickle.loads(data)
+
+        self.metrics.inc('bytes_in', self.procedure_name(message), len(data))
+
+        lane = self.priority_lane(message)
+
+        # Replies are answers to our own requests, so those are always let in
+        if message[0] not in ('reply', 'busy', 'error') and not self.rate_limiter.allow(peer):
+            logger.warning('rate limited %r, dropping %r', peer, Short(message[:3]))
+            return
+
+        # A full lane sheds its oldest message
+        if len(self.inbound_lanes[lane]) == config.INBOUND_LANE_SIZE:
+            self.shed(*self.inbound_lanes[lane].popleft())
+
+        self.inbound_lanes[lane].append((message, peer))
+
+        if not self.drain_scheduled:
+            self.drain_scheduled = True
+            asyncio.get_event_loop().call_soon(self.drain_inbound)
+
+    def procedure_name(self, message):
+        """
+        The procedure a message is about (or just its type.)
+        """
+
+        msg_type = message[0]
+
+        if msg_type in ('request', 'broadcast'):
+            return message[2]
+
+        if msg_type in ('reply', 'busy', 'error') and message[1] in self.request_info:
+            return self.request_info[message[1]][0]
+
+        return msg_type
+
+    def priority_lane(self, message):
+        msg_type = message[0]
+
+        if msg_type in ('reply', 'busy', 'error'):
+            return 0
+
+        if msg_type in ('request', 'broadcast'):
+            name = message[2]
+        else:
+            name = msg_type
+
+        lane = config.PRIORITY_LANES.get(name, config.DEFAULT_PRIORITY_LANE)
+        return min(lane, len(self.inbound_lanes) - 1)
+
+    def shed(self, message, peer):
+        procedure_name = self.procedure_name(message)
+
+        logger.warning('inbound queue full, dropping %r from %r', procedure_name, peer)
+        self.metrics.inc('shed', procedure_name)
+
+        # Let whoever is waiting on a request know, rather than have them time out
+        if message[0] == 'request':
+            self.busy(peer, message[1])
+
+    def drain_inbound(self):
+        """
+        Handle atmost INBOUND_BUDGET queued messages, highest priority first,
+        but atleast INBOUND_MIN_SHARE from each of the lower lanes (if queued)
+        so that they aren't starved by a steady stream of higher priority ones.
+        """
+
+        self.drain_scheduled = False
+
+        try:
+            reserved = [0] + [min(len(lane), config.INBOUND_MIN_SHARE) for lane in self.inbound_lanes[1:]]
+
+            for _ in range(config.INBOUND_BUDGET - sum(reserved)):
+                lane = next((lane for lane in self.inbound_lanes if lane), None)
+                if lane is None:
+                    break
+
+                self.handle_inbound(*lane.popleft())
+
+            for lane, count in zip(self.inbound_lanes, reserved):
+                for _ in range(min(count, len(lane))):
+                    self.handle_inbound(*lane.popleft())
+
+        finally:
+            # Whatever is left over is handled in the next tick
+            # (letting newly arrived high priority messages jump ahead)
+            if any(self.inbound_lanes) and not self.drain_scheduled:
+                self.drain_scheduled = True
+                asyncio.get_event_loop().call_soon(self.drain_inbound)
+
+    def handle_inbound(self, message, peer):
+        self.last_procedure = self.procedure_name(message)
+
+        started = time.perf_counter()
+        try:
+            self.message_received(message, peer)
+        except Exception:
+            # One bad message mustn't hold up the rest of the queue
+            logger.exception('handling %r from %r failed', self.last_procedure, peer)
+        elapsed = time.perf_counter() - started
+
+        if elapsed > config.SLOW_CALLBACK_THRESHOLD:
+            self.metrics.inc('slow_handlers', self.last_procedure)
+            self.profiler.slow_callback("handling %r" % self.last_procedure, elapsed)
+
+    def message_received(self, message, peer):
+        msg_type, message_identifier, *details = message
 
         if msg_type == 'broadcast':
             procedure_name, *args = details
@@ -70,37 +342,116 @@ class DatagramRPCProtocol(asyncio.DatagramProtocol):
             response = details[0]
             self.reply_received(peer, message_identifier, response)
 
+        elif msg_type == 'busy':
+            self.busy_received(peer, message_identifier)
+
+        elif msg_type == 'error':
+            description = details[0]
+            self.error_received(peer, message_identifier, description)
+
+        elif msg_type == 'inv':
+            peer_identifier = details[0]
+            self.inv_received(peer, message_identifier, peer_identifier)
+
+        elif msg_type == 'getdata':
+            peer_identifier = details[0]
+            self.getdata_received(peer, message_identifier, peer_identifier)
+
     def broadcast_received(self, peer, message_identifier, procedure_name, *args):
-        logger.info('received broadcast from %r: %r(*%r) as message %r',
-                    peer, procedure_name, args, message_identifier)
+        trace('received broadcast from %r: %r(*%r) as message %r',
+              peer, procedure_name, args, message_identifier)
+
+        self.metrics.inc('broadcasts_received', procedure_name)
         reply_function = self.reply_functions[procedure_name]
-        reply_function(self, peer, *args)
+        result = reply_function(self, peer, *args)
+
+        if asyncio.iscoroutine(result):
+            if not self.dispatcher.submit(procedure_name, result):
+                logger.warning('dropped broadcast %r(*%r), too busy', procedure_name, Short(args))
 
     def request_received(self, peer, message_identifier, procedure_name, args, kwargs):
-        logger.info('received request from %r: %r(*%r, **%r) as message %r',
-                    peer, procedure_name, args, kwargs, message_identifier)
+        trace('received request from %r: %r(*%r, **%r) as message %r',
+              peer, procedure_name, args, kwargs, message_identifier)
 
-        reply_function = self.reply_functions[procedure_name]
-        response = reply_function(self, peer, *args, **kwargs)
-        self.reply(peer, message_identifier, response)
+        self.metrics.inc('requests_received', procedure_name)
+
+        try:
+            reply_function = self.reply_functions[procedure_name]
+            response = reply_function(self, peer, *args, **kwargs)
+        except Exception as e:
+            logger.error('handling %r failed: %r', procedure_name, e)
+            self.error(peer, message_identifier, repr(e))
+            return
+
+        if asyncio.iscoroutine(response):
+            self.dispatch(peer, message_identifier, procedure_name, response)
+        else:
+            self.reply(peer, message_identifier, response, procedure_name)
+
+    def dispatch(self, peer, message_identifier, procedure_name, coro):
+        """
+        Run a coroutine handler and reply once it's done.
+        """
+
+        def done(task):
+            if task.cancelled():
+                return
+
+            if task.exception() is not None:
+                logger.error('handling %r failed: %r', procedure_name, task.exception())
+                self.error(peer, message_identifier, repr(task.exception()))
+                return
+
+            self.reply(peer, message_identifier, task.result(), procedure_name)
+
+        if not self.dispatcher.submit(procedure_name, coro, done):
+            logger.warning('too busy to handle %r from %r', procedure_name, peer)
+            self.metrics.inc('shed', procedure_name)
+            self.busy(peer, message_identifier)
 
     def reply_received(self, peer, message_identifier, response):
-        logger.info('received reply to message %r, response %r', message_identifier, response)
+        trace('received reply to message %r, response %r', message_identifier, response)
 
         if message_identifier in self.outstanding_requests:
+            procedure_name, sent_at = self.request_info.pop(message_identifier)
+            self.metrics.observe('rtt_seconds', procedure_name, asyncio.get_event_loop().time() - sent_at)
+
             reply = self.outstanding_requests.pop(message_identifier)
             reply.set_result(response)
 
+    def busy_received(self, peer, message_identifier):
+        trace('peer %r is too busy to handle message %r', peer, message_identifier)
+
+        if message_identifier in self.outstanding_requests:
+            procedure_name, _ = self.request_info.pop(message_identifier)
+            self.metrics.inc('busy_received', procedure_name)
+
+            reply = self.outstanding_requests.pop(message_identifier)
+            reply.set_exception(RPCBusy(peer))
+
+    def error_received(self, peer, message_identifier, description):
+        trace('peer %r failed to handle message %r: %s', peer, message_identifier, description)
+
+        if message_identifier in self.outstanding_requests:
+            procedure_name, _ = self.request_info.pop(message_identifier)
+            self.metrics.inc('errors_received', procedure_name)
+
+            reply = self.outstanding_requests.pop(message_identifier)
+            reply.set_exception(RPCError(peer, description))
+
     def reply_timed_out(self, message_identifier):
         if message_identifier in self.outstanding_requests:
+            procedure_name, _ = self.request_info.pop(message_identifier)
+            self.metrics.inc('timeouts', procedure_name)
+
             reply = self.outstanding_requests.pop(message_identifier)
             reply.set_exception(socket.timeout)
 
     def request(self, peer, procedure_name, *args, **kwargs):  # args[0] must always be senders nodeid
         message_identifier = random_id()
 
-        logger.info("sending request to %r: %r(*%r, **%r) as message %r",
-                    peer, procedure_name, args, kwargs, message_identifier)
+        trace("sending request to %r: %r(*%r, **%r) as message %r",
+              peer, procedure_name, args, kwargs, message_identifier)
 
         reply = asyncio.Future()
         self.outstanding_requests[message_identifier] = reply
@@ -108,17 +459,113 @@ class DatagramRPCProtocol(asyncio.DatagramProtocol):
         loop = asyncio.get_event_loop()
         loop.call_later(self.reply_timeout, self.reply_timed_out, message_identifier)
 
+        self.request_info[message_identifier] = (procedure_name, loop.time())
+        self.metrics.inc('requests_sent', procedure_name)
+
         obj = ('request', message_identifier, procedure_name, args, kwargs)
         message = pickle.dumps(obj, protocol=0)
-        self.transport.sendto(message, peer)
+        self.send_datagram(message, peer, procedure_name)
 
         return reply
 
-    def reply(self, peer, message_identifier, response):
-        logger.info("sending reply to %r: (%r, %r)",
-                    peer, message_identifier, response)
+    def reply(self, peer, message_identifier, response, procedure_name='reply'):
+        trace("sending reply to %r: (%r, %r)",
+              peer, message_identifier, response)
 
         obj = ('reply', message_identifier, response)
         message = pickle.dumps(obj, protocol=0)
 
-        self.transport.sendto(message, peer)
+        self.send_datagram(message, peer, procedure_name)
+
+    def busy(self, peer, message_identifier):
+        trace("sending busy to %r for message %r", peer, message_identifier)
+
+        obj = ('busy', message_identifier)
+        message = pickle.dumps(obj, protocol=0)
+
+        self.send_datagram(message, peer, 'busy')
+
+    def error(self, peer, message_identifier, description):
+        trace("sending error to %r for message %r", peer, message_identifier)
+
+        obj = ('error', message_identifier, description)
+        message = pickle.dumps(obj, protocol=0)
+
+        self.send_datagram(message, peer, 'error')
+
+    def send_datagram(self, message, peer, procedure_name='other'):
+        """
+        Send a pickled message to peer, possibly batched with others.
+        """
+
+        self.metrics.inc('bytes_out', procedure_name, len(message))
+
+        if not self.coalesce:
+            self.transport.sendto(message, peer)
+            return
+
+        queue = self.send_queues.setdefault(peer, [])
+        framed = len(message) + FRAME_HEADER.size
+
+        # Too big to be batched with whatever is already queued
+        # (a batch starts with BATCH_MAGIC)
+        if len(BATCH_MAGIC) + self.queued_bytes.get(peer, 0) + framed > config.DATAGRAM_MTU:
+            self.flush_peer(peer)
+
+            if len(BATCH_MAGIC) + framed > config.DATAGRAM_MTU:
+                self.transport.sendto(message, peer)
+                return
+
+            queue = self.send_queues.setdefault(peer, [])
+
+        self.queued_bytes[peer] = self.queued_bytes.get(peer, 0) + framed
+        queue.append(message)
+
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_event_loop().call_soon(self.flush_send_queues)
+
+    def flush_peer(self, peer):
+        queue = self.send_queues.pop(peer, None)
+        self.queued_bytes.pop(peer, None)
+
+        if not queue:
+            return
+
+        if len(queue) == 1:
+            self.transport.sendto(queue[0], peer)
+        else:
+            self.transport.sendto(batch(queue), peer)
+
+    def flush_send_queues(self):
+        self.flush_scheduled = False
+
+        for peer in list(self.send_queues):
+            self.flush_peer(peer)
+
+
+def batch(messages):
+    """
+    Frame a list of pickled messages into a single datagram.
+    """
+
+    frames = [BATCH_MAGIC]
+    for message in messages:
+        frames.append(FRAME_HEADER.pack(len(message)))
+        frames.append(message)
+
+    return b''.join(frames)
+
+
+def unbatch(data):
+    """
+    Split a datagram created by batch() back into messages.
+    """
+
+    offset = len(BATCH_MAGIC)
+    while offset < len(data):
+        size, = FRAME_HEADER.unpack_from(data, offset)
+        offset += FRAME_HEADER.size
+
+        yield data[offset:offset + size]
+        offset += size
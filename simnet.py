@@ -0,0 +1,352 @@
+import asyncio
+import random
+import selectors
+import sys
+import time
+
+import config
+import transaction
+
+from utils import random_id
+
+# Largest payload a real UDP socket would let us send
+MAX_DATAGRAM = 65507
+
+
+class SimulatedTransport(asyncio.DatagramTransport):
+
+    """
+    A datagram transport whose packets go through a SimulatedNetwork.
+    """
+
+    def __init__(self, network, sock_addr, protocol):
+        super(SimulatedTransport, self).__init__()
+
+        self.network = network
+        self.sock_addr = sock_addr
+        self.protocol = protocol
+        self.closed = False
+
+    def get_extra_info(self, name, default=None):
+        if name == 'sockname':
+            return self.sock_addr
+
+        return default
+
+    def sendto(self, data, addr=None):
+        if not self.closed:
+            self.network.send(self.sock_addr, addr, data)
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.network.unregister(self.sock_addr)
+        asyncio.get_event_loop().call_soon(self.protocol.connection_lost, None)
+
+    def abort(self):
+        self.close()
+
+
+class SimulatedNetwork(object):
+
+    """
+    Delivers datagrams between protocols living in the same event loop.
+
+    Every link has a latency (plus some random jitter) and a probability of
+    losing a datagram, these can be set per link. Partitions stop all traffic
+    between groups of addresses. All randomness comes from a seeded RNG.
+    """
+
+    def __init__(self, latency=0.01, jitter=0.005, loss=0.0, seed=None):
+
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+
+        self.random = random.Random(seed)
+
+        # sock_addr => protocol
+        self.endpoints = {}
+
+        # frozenset of two sock_addrs => (latency, loss)
+        self.links = {}
+
+        # sock_addr => partition it's in (unlisted addresses can reach everyone)
+        self.partitions = {}
+
+        self.sent = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.bytes = 0
+
+    def address(self, index):
+        """
+        A mininet style address for the index'th host.
+        """
+
+        index += 1
+        return ('10.%d.%d.%d' % ((index >> 16) & 255, (index >> 8) & 255, index & 255), config.PORT)
+
+    @asyncio.coroutine
+    def create_datagram_endpoint(self, protocol_factory, local_addr=None):
+        """
+        Like loop.create_datagram_endpoint, an address is picked if none is given.
+        """
+
+        if local_addr is None:
+            local_addr = self.address(len(self.endpoints))
+
+        if local_addr in self.endpoints:
+            raise OSError("Address already in use: %r" % (local_addr, ))
+
+        protocol = protocol_factory()
+        transport = SimulatedTransport(self, local_addr, protocol)
+
+        self.endpoints[local_addr] = protocol
+        protocol.connection_made(transport)
+
+        return transport, protocol
+
+    def unregister(self, sock_addr):
+        self.endpoints.pop(sock_addr, None)
+
+    def set_link(self, a, b, latency=None, loss=None):
+        self.links[frozenset((a, b))] = (
+            self.latency if latency is None else latency,
+            self.loss if loss is None else loss
+        )
+
+    def partition(self, *groups):
+        """
+        Only let addresses in the same group talk to each other.
+        """
+
+        self.partitions = {
+            sock_addr: i
+            for i, group in enumerate(groups)
+            for sock_addr in group
+        }
+
+    def heal(self):
+        self.partitions = {}
+
+    def reachable(self, src, dst):
+        if src not in self.partitions or dst not in self.partitions:
+            return True
+
+        return self.partitions[src] == self.partitions[dst]
+
+    def send(self, src, dst, data):
+        self.sent += 1
+        self.bytes += len(data)
+
+        latency, loss = self.links.get(frozenset((src, dst)), (self.latency, self.loss))
+
+        if (dst not in self.endpoints or len(data) > MAX_DATAGRAM or
+                not self.reachable(src, dst) or self.random.random() < loss):
+            self.dropped += 1
+            return
+
+        delay = latency + self.random.uniform(0, self.jitter)
+        asyncio.get_event_loop().call_later(delay, self.deliver, src, dst, data)
+
+    def deliver(self, src, dst, data):
+        # The receiver may have gone away while this was in flight
+        protocol = self.endpoints.get(dst)
+        if protocol is None:
+            self.dropped += 1
+            return
+
+        self.delivered += 1
+        protocol.datagram_received(data, src)
+
+    def stats(self):
+        return {
+            'endpoints': len(self.endpoints),
+            'sent': self.sent,
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'bytes': self.bytes,
+        }
+
+
+class VirtualClockSelector(object):
+
+    """
+    Wraps a real selector, but instead of blocking it moves the loop's clock.
+    """
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.selector = selectors.DefaultSelector()
+
+    def select(self, timeout=None):
+        # The loop waits only for its next timer, so
+        # it's safe to jump straight to it
+        events = self.selector.select(0)
+
+        if not events and timeout:
+            self.loop.advance(timeout)
+
+        # No timers at all, only a real event (a signal or
+        # call_soon_threadsafe) can wake us up
+        if not events and timeout is None:
+            events = self.selector.select(None)
+
+        return events
+
+    def __getattr__(self, name):
+        return getattr(self.selector, name)
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+
+    """
+    An event loop where time only passes when there's nothing else to do.
+
+    Sleeps & timeouts take no real time, so long simulations on a
+    SimulatedNetwork finish as fast as the CPU allows. Executor jobs are run
+    inline, which keeps the order of events (and so results) reproducible.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+        super(VirtualTimeLoop, self).__init__(VirtualClockSelector(self))
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+    def run_in_executor(self, executor, func, *args):
+        future = self.create_future()
+
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+        return future
+
+
+def use_virtual_time():
+    """
+    Switch to a VirtualTimeLoop, that transactions take their ids from too.
+    """
+
+    loop = VirtualTimeLoop()
+    asyncio.set_event_loop(loop)
+
+    transaction.clock = loop.time
+
+    return loop
+
+
+@asyncio.coroutine
+def start_nodes(network, count, node_factory, concurrency=32):
+    """
+    Create count nodes on the network, the first one bootstraps the rest.
+    """
+
+    nodes = []
+    for _ in range(count):
+        _, node = yield from network.create_datagram_endpoint(node_factory)
+        nodes.append(node)
+
+    # The bootstrapper stores its own record (see start_node_repl)
+    bootstrap = nodes[0]
+    bootstrap.storage.set(bootstrap.identifier, (bootstrap.socket_addr, bootstrap.pub_key), owned=True)
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    @asyncio.coroutine
+    def join(node):
+        yield from semaphore.acquire()
+        try:
+            yield from node.join(known_nodes=bootstrap.socket_addr)
+        finally:
+            semaphore.release()
+
+    yield from asyncio.gather(*[join(node) for node in nodes[1:]])
+
+    return nodes
+
+
+@asyncio.coroutine
+def broadcast_reach(nodes, wait=5):
+    """
+    Broadcast a (harmless) ping from the last node & wait a while. Returns
+    how many of the nodes that aren't its peers (i.e. are more than one hop
+    away) it reached, and how many of those there are.
+    """
+
+    source = nodes[-1]
+    peers = set(peer_identifier for peer_identifier, _ in source.routing_table)
+    far = [node for node in nodes[:-1] if node.identifier not in peers]
+
+    message_identifier = random_id()
+    yield from source.broadcast(message_identifier, 'ping', source.identifier)
+    yield from asyncio.sleep(wait)
+
+    return len([node for node in far if message_identifier in node.broadcast_list]), len(far)
+
+
+if __name__ == '__main__':
+
+    # Usage: simnet.py [--virtual] [nodes] [latency] [loss] [seed] [duration]
+    from node import Node
+    from start_node import two_phase_protocol, maintain_routing_table, maintain_storage
+
+    virtual = '--virtual' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--virtual']
+
+    count = int(args[0]) if len(args) > 0 else 100
+    seed = int(args[3]) if len(args) > 3 else None
+    duration = float(args[4]) if len(args) > 4 else 5
+
+    network = SimulatedNetwork(
+        latency=float(args[1]) if len(args) > 1 else 0.01,
+        loss=float(args[2]) if len(args) > 2 else 0.0,
+        seed=seed
+    )
+
+    # Node identifiers & message ids come from the random module
+    random.seed(seed)
+
+    if virtual:
+        use_virtual_time()
+
+    loop = asyncio.get_event_loop()
+
+    started = time.time()
+    nodes = loop.run_until_complete(start_nodes(network, count, Node))
+    print("Joined %d nodes in %.2fs: %r" % (count, time.time() - started, network.stats()))
+
+    peers = [len(node.routing_table.index) for node in nodes]
+    print("Routing table sizes: min %d, avg %.1f, max %d" % (min(peers), sum(peers) / len(peers), max(peers)))
+
+    for node in nodes:
+        loop.create_task(two_phase_protocol(node))
+        loop.create_task(maintain_routing_table(node))
+        loop.create_task(maintain_storage(node))
+
+    # One transfer, then let the network run for a while
+    sender, receiver, witness = nodes[1:4] if count > 3 else nodes[:3]
+    loop.run_until_complete(sender.send_amount(sender.socket_addr, sender.identifier, receiver.identifier, witness.identifier, 10))
+
+    started, loop_started = time.time(), loop.time()
+    loop.run_until_complete(asyncio.sleep(duration))
+    print("Simulated %.0fs in %.2fs" % (loop.time() - loop_started, time.time() - started))
+
+    reached, far = loop.run_until_complete(broadcast_reach(nodes))
+    print("A broadcast reached %d of the %d nodes beyond its first hop" % (reached, far))
+
+    sizes = [len(node.ledger.record) for node in nodes]
+    print("Ledger sizes: min %d, max %d: %r" % (min(sizes), max(sizes), network.stats()))
@@ -0,0 +1,204 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import time
+
+from functools import partial
+
+import config
+import keystore
+
+from node import Node
+from start_node import setup_logging, start_tasks, state_path, wal_path
+
+
+@asyncio.coroutine
+def start_nodes(addrs, bootstrap_addrs, stagger, concurrency, bootstrapped):
+    """
+    Create a node on each of addrs & join them via bootstrap_addrs.
+
+    If the first of addrs is also the first bootstrap address, that node is
+    the bootstrapper, and bootstrapped() is called as soon as everyone else
+    can join via it. Returns the nodes, and how many of them have atleast
+    one peer.
+    """
+
+    loop = asyncio.get_event_loop()
+
+    nodes = []
+    for addr in addrs:
+        identity = keystore.load_or_create(keystore.key_path(addr))
+        _, node = yield from loop.create_datagram_endpoint(partial(Node, identity=identity), local_addr=addr)
+
+        # Peers, values & 2PC state from our last run (if any)
+        node.load_state(state_path(addr))
+        node.open_wal(wal_path(node))
+
+        nodes.append(node)
+
+    joining = nodes
+
+    if addrs[0] == bootstrap_addrs[0]:
+        # Store my pub_key in my dht (as start_node_repl does)
+        bootstrap = nodes[0]
+        bootstrap.storage.set(bootstrap.identifier, (bootstrap.socket_addr, bootstrap.pub_key), owned=True)
+
+        joining = nodes[1:]
+        bootstrapped()
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    @asyncio.coroutine
+    def join(node):
+        if node.socket_addr in bootstrap_addrs:
+            # The other bootstrappers join the first one, right away
+            known_nodes = bootstrap_addrs[:1]
+        else:
+            # Spread out the load on the bootstrappers
+            known_nodes = bootstrap_addrs
+            yield from asyncio.sleep(random.uniform(0, stagger))
+
+        yield from semaphore.acquire()
+        try:
+            yield from node.join(known_nodes=known_nodes, background=True)
+        finally:
+            semaphore.release()
+
+        return len(node.routing_table.index) > 0
+
+    joined = yield from asyncio.gather(*[join(node) for node in joining])
+
+    return nodes, len(nodes) - len(joining) + sum(joined)
+
+
+def run_process(index, addrs, bootstrap_addrs, stagger, concurrency, events):
+    """
+    Runs in each of the fleet's processes, hosting all of addrs' nodes on one event loop.
+    """
+
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    loop = asyncio.get_event_loop()
+
+    # Stop when the fleet does (Ctrl+C reaches the whole process group)
+    loop.add_signal_handler(signal.SIGINT, loop.stop)
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+
+    # One log for all the nodes in this process
+    setup_logging("fleet_%d" % index, to_file=True)
+
+    # Message ids (and new identities) come from the random module,
+    # so forked processes mustn't share its state
+    random.seed()
+
+    started = time.time()
+
+    try:
+        nodes, ready = loop.run_until_complete(start_nodes(
+            addrs, bootstrap_addrs, stagger, concurrency,
+            bootstrapped=lambda: events.put(('bootstrapped', index))
+        ))
+    except RuntimeError:
+        # Stopped before every node had joined
+        return
+
+    events.put(('ready', index, ready, len(nodes), time.time() - started))
+
+    for node in nodes:
+        start_tasks(node, state_path(node.socket_addr))
+
+    loop.run_forever()
+
+    for node in nodes:
+        node.save_state(state_path(node.socket_addr))
+        node.close_wal()
+
+
+def start_fleet(count, ip='127.0.0.1', port=config.PORT, processes=None,
+                stagger=config.JOIN_STAGGER, concurrency=config.FLEET_JOIN_CONCURRENCY):
+    """
+    Start count nodes on consecutive ports, packed into processes processes
+    (one per core by default). Returns the processes once every node is
+    ready, or READY_TIMEOUT has passed.
+    """
+
+    processes = min(processes or os.cpu_count(), count)
+    addrs = [(ip, port + i) for i in range(count)]
+
+    # Contiguous chunks, so that the bootstrappers all start in the first process
+    size = -(-count // processes)
+    chunks = [addrs[i:i + size] for i in range(0, count, size)]
+
+    bootstrap_addrs = chunks[0][:config.BOOTSTRAP_NODES]
+
+    events = multiprocessing.Queue()
+    started = time.time()
+    deadline = started + config.READY_TIMEOUT
+
+    def spawn(index):
+        process = multiprocessing.Process(
+            target=run_process,
+            args=(index, chunks[index], bootstrap_addrs, stagger, concurrency, events),
+            daemon=True
+        )
+        process.start()
+        return process
+
+    fleet = [spawn(0)]
+
+    waiting = len(chunks)
+    ready = 0
+
+    while waiting and time.time() < deadline:
+        try:
+            event = events.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            break
+
+        if event[0] == 'bootstrapped':
+            # Everyone else can join now
+            print("Bootstrappers up in %.1fs" % (time.time() - started))
+            fleet += [spawn(index) for index in range(1, len(chunks))]
+        else:
+            _, index, process_ready, process_count, seconds = event
+            print("Process %d: %d/%d nodes ready in %.1fs" % (index, process_ready, process_count, seconds))
+
+            waiting -= 1
+            ready += process_ready
+
+    print("%d/%d nodes ready in %.1fs (%d processes)" % (ready, count, time.time() - started, len(chunks)))
+
+    return fleet
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Start many headless nodes, packed into a few processes.')
+    parser.add_argument('nodes', type=int)
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=config.PORT, help='port of the first node, the rest use the next ones')
+    parser.add_argument('--processes', type=int, help='default: one per core')
+    parser.add_argument('--stagger', type=float, default=config.JOIN_STAGGER, help='seconds to spread joins over')
+    parser.add_argument('--concurrency', type=int, default=config.FLEET_JOIN_CONCURRENCY, help='joins at once, per process')
+
+    args = parser.parse_args()
+
+    # Stopping the launcher stops the fleet
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    fleet = start_fleet(args.nodes, args.ip, args.port, args.processes, args.stagger, args.concurrency)
+
+    try:
+        for process in fleet:
+            process.join()
+    except KeyboardInterrupt:
+        # Wait for the processes to save their state
+        for process in fleet:
+            process.terminate()
+            process.join()
+
+
+if __name__ == '__main__':
+    main()
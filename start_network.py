@@ -20,6 +20,21 @@ from mininet.topo import LinearTopo
 # Used by start_control_server
 NET = None
 
+# Nodes run without xterms (see node_cmd)
+HEADLESS = False
+
+
+def ready_path(sock_addr):
+    """
+    The marker a node touches once it has joined (as start_node.ready_path,
+    which can't be imported here - start_node.py is Python 3 only.)
+    """
+
+    if not os.path.exists(config.LOG_DIR):
+        os.mkdir(config.LOG_DIR)
+
+    return os.path.join(config.LOG_DIR, config.READY_FILE % sock_addr)
+
 
 def cleanup(remove_logs=False):
 
@@ -38,12 +53,14 @@ def cleanup(remove_logs=False):
             os.remove(f)
 
 
-def xterm_cmd(ip, port, b_ip=None, b_port=None):
+def xterm_cmd(ip, port, bootstraps=None):
 
-    if b_ip:
+    if bootstraps:
         title = "Host_%d: "
         file = "start_node.py"
-        args = "%s %d %s %d" % (ip, port, b_ip, b_port)
+        args = "%s %d" % (ip, port)
+        for b_ip, b_port in bootstraps:
+            args += " %s %d" % (b_ip, b_port)
     else:
         title = "Host_%d - Bootstrap REPL: "
         file = "start_node_repl.py"
@@ -56,8 +73,78 @@ def xterm_cmd(ip, port, b_ip=None, b_port=None):
     return cmd % (title, file, args)
 
 
-def start_network(nodes=3):
-    global NET
+def node_cmd(ip, port, bootstraps=None, stagger=0):
+    """
+    Like xterm_cmd, but runs start_node.py in the background (even for
+    the bootstrapper) with its output going to LOG_DIR.
+    """
+
+    args = "--stagger=%s %s %d" % (stagger, ip, port)
+    for b_ip, b_port in bootstraps or []:
+        args += " %s %d" % (b_ip, b_port)
+
+    output = os.path.join(config.LOG_DIR, "%s_%d.out" % (ip, port))
+
+    return 'python3 -u start_node.py %s > "%s" 2>&1 &' % (args, output)
+
+
+def wait_ready(hosts, timeout=config.READY_TIMEOUT):
+    """
+    Wait until every host's node has joined, returns the ones that haven't.
+    """
+
+    deadline = time.time() + timeout
+    waiting = list(hosts)
+
+    while waiting and time.time() < deadline:
+        time.sleep(0.1)
+        waiting = [host for host in waiting if not os.path.exists(ready_path((host.IP(), config.PORT)))]
+
+    return waiting
+
+
+def bootstrap_addrs(hosts):
+    """
+    Addresses of (atmost config.BOOTSTRAP_NODES) hosts to join the network via.
+    """
+
+    return [(host.IP(), config.PORT) for host in hosts[:config.BOOTSTRAP_NODES]]
+
+
+def start_headless(hosts, stagger=config.JOIN_STAGGER):
+    """
+    Start the first host's node, then the rest of the bootstrappers, then
+    everyone else - all at once, but with joins spread over stagger seconds.
+    """
+
+    started = time.time()
+    bootstraps = hosts[:config.BOOTSTRAP_NODES]
+
+    # Markers left over from an earlier run (ready_path creates LOG_DIR too)
+    for host in hosts:
+        path = ready_path((host.IP(), config.PORT))
+        if os.path.exists(path):
+            os.remove(path)
+
+    for group, joining_via, spread in [
+        (hosts[:1], [], 0),
+        (bootstraps[1:], hosts[:1], 0),
+        (hosts[len(bootstraps):], bootstraps, stagger),
+    ]:
+        for host in group:
+            host.cmd(node_cmd(host.IP(), config.PORT, bootstrap_addrs(joining_via), spread))
+
+        failed = wait_ready(group)
+        if failed:
+            print("Not ready after %ds: %s" % (config.READY_TIMEOUT, ", ".join(map(str, failed))))
+
+    print("Started %d nodes in %.1fs" % (len(hosts), time.time() - started))
+
+
+def start_network(nodes=3, headless=False):
+    global NET, HEADLESS
+
+    HEADLESS = headless
 
     NET = Mininet(
         # NOTE: This is actually a SingleTopo
@@ -69,6 +156,10 @@ def start_network(nodes=3):
     # Start the network
     NET.start()
 
+    if headless:
+        start_headless(NET.hosts)
+        return
+
     # The first node acts as a bootstrapper for other
     c = xterm_cmd(
         ip=NET.hosts[0].IP(),
@@ -87,8 +178,7 @@ def start_network(nodes=3):
         c = xterm_cmd(
             ip=host.IP(),
             port=config.PORT,
-            b_ip=NET.hosts[0].IP(),
-            b_port=config.PORT
+            bootstraps=bootstrap_addrs(NET.hosts[:i+1])
         )
 
         host.cmd(c % (i+2))
@@ -129,14 +219,16 @@ class MininetREPL(REPL):
         new_switch.start(NET.controllers)
         new_host.configDefault(defaultRoute=new_host.defaultIntf())
 
-        c = xterm_cmd(
-            ip=new_host.IP(),
-            port=config.PORT,
-            b_ip=NET.hosts[0].IP(),
-            b_port=config.PORT
-        )
+        if HEADLESS:
+            new_host.cmd(node_cmd(new_host.IP(), config.PORT, bootstrap_addrs(NET.hosts[:-1])))
+        else:
+            c = xterm_cmd(
+                ip=new_host.IP(),
+                port=config.PORT,
+                bootstraps=bootstrap_addrs(NET.hosts[:-1])
+            )
 
-        new_host.cmd(c % host_num)
+            new_host.cmd(c % host_num)
 
         print("Started new node: %s" % new_host)
 
@@ -173,8 +265,10 @@ if __name__ == '__main__':
 
     try:
 
+        # Usage: start_network.py nodes [--headless]
         start_network(
-            nodes=int(sys.argv[1])
+            nodes=int(sys.argv[1]),
+            headless='--headless' in sys.argv
         )
 
         MininetREPL().cmdloop()
@@ -1,13 +1,22 @@
 import asyncio
 import logging
 import os
+import random
 import sys
 import signal
+import socket
+
+from functools import partial
 
 import config
+import keystore
+import metrics
+import tracing
+import transaction
 
 from node import Node
-from utils import random_id, sign_msg
+from rpc_protocol import RPCBusy
+from utils import sign_msg
 
 
 def setup_logging(node_id, to_file=False):
@@ -20,10 +29,13 @@ def setup_logging(node_id, to_file=False):
     kademlia_logger = logging.getLogger('node')
     kademlia_logger.setLevel(config.LOGLEVEL)
 
+    # Subsystems may be more (or less) verbose than the rest,
+    # so the handler itself doesn't filter anything
+    tracing.setup_levels()
+
     stream_handler = logging.StreamHandler()
     if to_file:
         stream_handler = logging.FileHandler('logs/%s.log' % node_id, "w")
-    stream_handler.setLevel(config.LOGLEVEL)
 
     format_ = logging.Formatter('\n%(asctime)s - %(message)s\n')
     stream_handler.setFormatter(format_)
@@ -38,30 +50,165 @@ def continuous_ping(node, to, interval=5):
         yield from asyncio.sleep(interval)
 
 
+@asyncio.coroutine
+def maintain_routing_table(node, interval=60):
+    while True:
+        yield from asyncio.sleep(interval)
+        yield from node.refresh_buckets()
+
+
+@asyncio.coroutine
+def maintain_storage(node, interval=60):
+    while True:
+        yield from asyncio.sleep(interval)
+        yield from node.republish()
+
+
+@asyncio.coroutine
+def snapshot_state(node, path, interval=config.SNAPSHOT_INTERVAL):
+    while True:
+        yield from asyncio.sleep(interval)
+        node.save_state(path)
+
+
+def state_path(sock_addr):
+    if not os.path.exists(config.STATE_DIR):
+        os.mkdir(config.STATE_DIR)
+
+    return os.path.join(config.STATE_DIR, "%s_%d.state" % sock_addr)
+
+
+def ready_path(sock_addr):
+    """
+    Touched once a node has joined, for headless launchers to wait on.
+    """
+
+    if not os.path.exists(config.LOG_DIR):
+        os.mkdir(config.LOG_DIR)
+
+    return os.path.join(config.LOG_DIR, config.READY_FILE % sock_addr)
+
+
+def wal_path(node):
+    """
+    Keyed by identifier, which only survives a restart through the keystore.
+    """
+
+    if not os.path.exists(config.WAL_DIR):
+        os.mkdir(config.WAL_DIR)
+
+    return os.path.join(config.WAL_DIR, "%d.wal" % node.identifier)
+
+
+@asyncio.coroutine
+def compact_ledger(node, interval=config.COMPACTION_INTERVAL):
+    if not os.path.exists(config.ARCHIVE_DIR):
+        os.mkdir(config.ARCHIVE_DIR)
+
+    archive_path = os.path.join(config.ARCHIVE_DIR, "%d.archive" % node.identifier)
+
+    while True:
+        yield from asyncio.sleep(interval)
+
+        # Transaction ids are in nanoseconds, and the checkpoint is the
+        # last multiple of interval that's atleast an interval old
+        now = int(transaction.clock())
+        checkpoint = (now // interval - 1) * interval * 10**9
+
+        node.ledger.compact(checkpoint, archive_path, keep=node.pending_ids(checkpoint))
+
+
+@asyncio.coroutine
+def dump_stats(node, interval=config.STATS_INTERVAL):
+    path = os.path.join(config.LOG_DIR, "%d.stats.%s" % (node.identifier, config.STATS_FORMAT))
+
+    while True:
+        yield from asyncio.sleep(interval)
+        metrics.dump(node.stats(), path)
+
+
+# The log_* tasks only look at the node's state when DEBUG logging is on,
+# and only log what changed since the last time they did
+
 @asyncio.coroutine
 def log_routing_table(node, interval=5):
+    logger = logging.getLogger('node.dht')
+    previous = {}
+
     while True:
-        logger = logging.getLogger('node')
-        logger.debug("My Routing Table:\n" + str(node.routing_table))
+        if logger.isEnabledFor(logging.DEBUG):
+            current = dict(node.routing_table)
+            added, removed = tracing.changes(previous, current)
+
+            if added or removed:
+                logger.debug("My Routing Table: %d peers, added %r, removed %r",
+                             len(current), tracing.Short(added), tracing.Short(removed))
+
+            previous = current
+
         yield from asyncio.sleep(interval)
 
 
 @asyncio.coroutine
 def log_dht(node, interval=5):
+    logger = logging.getLogger('node.dht')
+    previous = {}
+
     while True:
-        logger = logging.getLogger('node')
-        logger.debug("My Hash Table:\n" + node.storage_str())
+        if logger.isEnabledFor(logging.DEBUG):
+            current = {key: id(value) for key, value in node.storage.items()}
+            updated, removed = tracing.changes(previous, current)
+
+            if updated or removed:
+                logger.debug("My Hash Table: %d keys, updated %r, removed %r",
+                             len(current), tracing.Short(list(updated)), tracing.Short(removed))
+
+            previous = current
+
         yield from asyncio.sleep(interval)
 
 
 @asyncio.coroutine
 def log_ledger(node, interval=5):
+    logger = logging.getLogger('node.ledger')
+    previous = {}
+
     while True:
-        logger = logging.getLogger('node')
-        logger.debug("My Ledger:\n" + repr(node.ledger))
+        if logger.isEnabledFor(logging.DEBUG):
+            current = {tx.id: tx.spent for tx in node.ledger.record}
+            updated, removed = tracing.changes(previous, current)
+
+            if updated or removed:
+                added = [tx for tx in node.ledger.record if tx.id in updated and tx.id not in previous]
+                spent = [tx_id for tx_id in updated if tx_id in previous]
+
+                logger.debug("My Ledger: %d transactions, added %r, spent flag changed %r, removed %r",
+                             len(current), tracing.Short(added), tracing.Short(spent), tracing.Short(removed))
+
+            previous = current
+
         yield from asyncio.sleep(interval)
 
 
+@asyncio.coroutine
+def abort_everywhere(node, txs):
+    """
+    Abort txs on everyone involved, as far as they can be reached.
+    """
+
+    logger = logging.getLogger('node')
+
+    for identifier in set([txs[0].receiver, txs[0].witness]):
+        try:
+            sock, _ = yield from node.get(identifier)
+            yield from node.abort_tx(sock, node.identifier, txs)
+        except (KeyError, socket.timeout, RPCBusy):
+            logger.info("Could not abort the transaction on %d", identifier)
+
+    # If even this fails, I'm still busy with txs and will try again
+    yield from node.quietly(node.abort_tx(node.socket_addr, node.identifier, txs))
+
+
 @asyncio.coroutine
 def two_phase_protocol(node):
     logger = logging.getLogger('node')
@@ -70,50 +217,62 @@ def two_phase_protocol(node):
             txs = node.isbusy[1]  # get that transaction
 
             if txs[0].sender == node.identifier:  # if current node is the sender
-                """Phase 1"""
-                print("I am sender")
+                try:
+                    """Phase 1"""
+                    print("I am sender")
 
-                digital_signature = sign_msg(node.pvt_key, repr(txs))
-                logger.info("Generated Digital Signature %r", digital_signature)
-                senders_pub_key = (yield from node.get(txs[0].sender))[1]
+                    digital_signature = sign_msg(node.pvt_key, repr(txs))
+                    logger.info("Generated Digital Signature %r", digital_signature)
 
-                receiver_sock = (yield from node.get(txs[0].receiver))[0]
-                receiver_status = yield from node.become_receiver(receiver_sock, node.identifier, txs)
+                    # Resolve all three identities at once (three random ids hardly
+                    # ever share a region, so get_many wouldn't save any lookups)
+                    sender, receiver, witness = yield from asyncio.gather(
+                        node.get(txs[0].sender), node.get(txs[0].receiver), node.get(txs[0].witness))
+                    senders_pub_key = sender[1]
 
-                witness_sock = (yield from node.get(txs[0].witness))[0]
-                witness_status = yield from node.become_witness(witness_sock, node.identifier, txs)
+                    receiver_sock = receiver[0]
+                    receiver_status = yield from node.become_receiver(receiver_sock, node.identifier, txs)
 
-                if receiver_status == "busy" or witness_status == "busy":
-                    logger.info("Phase 1 failed, aborting transaction!")
+                    witness_sock = witness[0]
+                    witness_status = yield from node.become_witness(witness_sock, node.identifier, txs)
 
-                    # Send abort to both receiver & witness
-                    receiver_abort = yield from node.abort_tx(receiver_sock, node.identifier, txs)
-                    witness_abort = yield from node.abort_tx(witness_sock, node.identifier, txs)
+                    if receiver_status == "busy" or witness_status == "busy":
+                        logger.info("Phase 1 failed, aborting transaction!")
 
-                    # If both of them have aborted then I'll abort too
-                    if (witness_abort == "aborted" and receiver_abort == "aborted"):
-                        yield from node.abort_tx(node.socket_addr, node.identifier, txs)
-                else:
-                    """ Phase 2 """
-                    logger.info("Phase 1 complete - Now entering Phase 2")
-
-                    # Send commit to both receiver & witness
-                    receiver_commit = yield from node.commit_tx(receiver_sock, node.identifier, txs, digital_signature, senders_pub_key)
-                    witness_commit = yield from node.commit_tx(witness_sock, node.identifier, txs, digital_signature, senders_pub_key)
-
-                    if (witness_commit == "committed" and receiver_commit == "committed"):
-                        logger.info("Phase 2 complete")
-                        yield from node.commit_tx(node.socket_addr, node.identifier, txs, digital_signature, senders_pub_key)  # Commit transaction
-                        yield from node.broadcast(random_id(), 'commit_tx', node.identifier, txs, digital_signature, senders_pub_key)
-                        node.isbusy = (False, None)
+                        # Send abort to both receiver & witness
+                        yield from node.abort_tx(receiver_sock, node.identifier, txs)
+                        yield from node.abort_tx(witness_sock, node.identifier, txs)
 
+                        # Whoever was busy never took part in this transaction,
+                        # so it won't reply "aborted"; I'll abort regardless
+                        # (retrying would deadlock two senders waiting on each other)
+                        yield from node.abort_tx(node.socket_addr, node.identifier, txs)
                     else:
-                        receiver_abort = yield from node.abort_tx(receiver_sock, node.identifier, txs)  # send abort to receiver
-                        witness_abort = yield from node.abort_tx(witness_sock, node.identifier, txs)  # send abort to witness
-
-                        if (witness_abort == "aborted" and receiver_abort == "aborted"):
-                            yield from node.abort_tx(node.socket_addr, node.identifier, txs)  # send abort to itslef(sender)
-                # do the work of sender
+                        """ Phase 2 """
+                        logger.info("Phase 1 complete - Now entering Phase 2")
+
+                        # Send commit to both receiver & witness
+                        receiver_commit = yield from node.commit_tx(receiver_sock, node.identifier, txs, digital_signature, senders_pub_key)
+                        witness_commit = yield from node.commit_tx(witness_sock, node.identifier, txs, digital_signature, senders_pub_key)
+
+                        if (witness_commit == "committed" and receiver_commit == "committed"):
+                            logger.info("Phase 2 complete")
+                            yield from node.commit_tx(node.socket_addr, node.identifier, txs, digital_signature, senders_pub_key)  # Commit transaction
+                            yield from node.publish_commit(txs, digital_signature, senders_pub_key)
+                            node.isbusy = (False, None)
+
+                        else:
+                            receiver_abort = yield from node.abort_tx(receiver_sock, node.identifier, txs)  # send abort to receiver
+                            witness_abort = yield from node.abort_tx(witness_sock, node.identifier, txs)  # send abort to witness
+
+                            if (witness_abort == "aborted" and receiver_abort == "aborted"):
+                                yield from node.abort_tx(node.socket_addr, node.identifier, txs)  # send abort to itslef(sender)
+                    # do the work of sender
+                except (KeyError, socket.timeout, RPCBusy) as e:
+                    # Someone couldn't be found, didn't answer, or failed
+                    # (RPCError is an RPCBusy too)
+                    logger.info("Transaction failed (%r), aborting!", e)
+                    yield from abort_everywhere(node, txs)
 
             elif txs[0].receiver == node.identifier:
                 print("I am receiver")
@@ -126,14 +285,42 @@ def two_phase_protocol(node):
         yield from asyncio.sleep(1)
 
 
-def start_node(sock_addr, bootstrap_addr=None):
+def start_tasks(node, path):
+    """
+    Start everything a node does in the background.
+    """
+
+    loop = asyncio.get_event_loop()
+
+    # Log the routing table & dht every two second
+    loop.create_task(log_routing_table(node, interval=2))
+    loop.create_task(log_dht(node, interval=2))
+    loop.create_task(log_ledger(node, interval=5))
+    loop.create_task(two_phase_protocol(node))
+    loop.create_task(maintain_routing_table(node))
+    loop.create_task(maintain_storage(node))
+    loop.create_task(snapshot_state(node, path))
+    loop.create_task(compact_ledger(node))
+
+    if config.STATS_FORMAT:
+        loop.create_task(dump_stats(node))
+
+
+def start_node(sock_addr, bootstrap_addrs=None, light=config.LIGHT_NODE, sharded=config.SHARDED_LEDGER, stagger=0):
 
     loop = asyncio.get_event_loop()
 
     # On receiving SIGINT Ctrl+C - try to stop the loop
     loop.add_signal_handler(signal.SIGINT, loop.stop)
 
-    f = loop.create_datagram_endpoint(Node, local_addr=sock_addr)
+    ready = ready_path(sock_addr)
+    if os.path.exists(ready):
+        os.remove(ready)
+
+    # Loading my identity is much cheaper than generating a key pair
+    identity = keystore.load_or_create(keystore.key_path(sock_addr))
+
+    f = loop.create_datagram_endpoint(partial(Node, light=light, sharded=sharded, identity=identity), local_addr=sock_addr)
     _, node = loop.run_until_complete(f)
 
     # Setup logging once we have the ID
@@ -141,28 +328,52 @@ def start_node(sock_addr, bootstrap_addr=None):
 
     logging.getLogger('node').info('MyId: %s', node.identifier)
 
+    # Peers & values from our last run (if any)
+    path = state_path(sock_addr)
+    node.load_state(path)
+
+    # Redo whatever happened after that snapshot
+    node.open_wal(wal_path(node))
+
     # For nodes that are not bootstrapper
-    if bootstrap_addr:
-        loop.run_until_complete(node.join(known_node=bootstrap_addr))
+    if bootstrap_addrs:
+        # Nodes launched together don't all join at the same instant
+        loop.run_until_complete(asyncio.sleep(random.uniform(0, stagger)))
+        # I'm ready once I know my closest peers, the rest happens in the background
+        loop.run_until_complete(node.join(known_nodes=bootstrap_addrs, background=True))
+    else:
+        # Store my pub_key in my dht (as start_node_repl does)
+        node.storage.set(node.identifier, (node.socket_addr, node.pub_key), owned=True)
+
+    # Ready once I know atleast one peer (or I'm the bootstrapper)
+    if not bootstrap_addrs or len(node.routing_table.index) > 0:
+        open(ready, 'w').close()
+
+    start_tasks(node, path)
 
-    # Log the routing table & dht every two second
-    loop.create_task(log_routing_table(node, interval=2))
-    loop.create_task(log_dht(node, interval=2))
-    loop.create_task(log_ledger(node, interval=5))
-    loop.create_task(two_phase_protocol(node))
     loop.run_forever()
 
+    node.save_state(path)
+    node.close_wal()
+
 
 if __name__ == '__main__':
 
     # TODO: Improved argument parsing via docopt or click
 
-    if len(sys.argv) == 5:
-        start_node(
-            sock_addr=(sys.argv[1], int(sys.argv[2])),
-            bootstrap_addr=(sys.argv[3], int(sys.argv[4]))
-        )
-    else:
-        start_node(
-            sock_addr=(sys.argv[1], int(sys.argv[2]))
-        )
+    # Usage: start_node.py [--light|--sharded] [--stagger=SECONDS] ip port [bootstrap_ip bootstrap_port]...
+    light = '--light' in sys.argv
+    sharded = '--sharded' in sys.argv
+    stagger = [float(arg.split('=')[1]) for arg in sys.argv if arg.startswith('--stagger=')]
+    args = [arg for arg in sys.argv if arg not in ('--light', '--sharded') and not arg.startswith('--stagger=')]
+
+    start_node(
+        sock_addr=(args[1], int(args[2])),
+        bootstrap_addrs=[
+            (args[i], int(args[i + 1]))
+            for i in range(3, len(args) - 1, 2)
+        ],
+        light=light or config.LIGHT_NODE,
+        sharded=sharded or config.SHARDED_LEDGER,
+        stagger=stagger[0] if stagger else 0
+    )
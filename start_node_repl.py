@@ -4,18 +4,21 @@ import sys
 import shlex
 import socket
 
+from functools import partial
+
 # TODO: Is cmd module made async a better alternative?
 # https://pymotw.com/2/cmd/index.html#module-cmd
 # https://stackoverflow.com/questions/37866403
 from aioconsole import ainput
 
+import keystore
+
 from node import Node
-from start_node import two_phase_protocol, setup_logging
+from rpc_protocol import RPCBusy
+from start_node import two_phase_protocol, maintain_routing_table, maintain_storage, compact_ledger, setup_logging
 
 from utils import random_id
-from node_repl_utils import get_sock_from_name, generate_help_dict
-
-HELP_DICT = generate_help_dict()
+from node_repl_utils import get_sock_from_name, generate_help_dict, format_stats, format_cluster_stats
 
 async def node_repl(node):
 
@@ -61,6 +64,44 @@ async def node_repl(node):
 
             print(node.routing_table)
 
+        elif cmd in ['st', 'stats']:
+            "Print RPC counters & latencies of a node (mine by default)"
+
+            if len(args) == 1:
+                try:
+                    stats = await node.get_stats(get_sock_from_name(args[0]), node.identifier)
+                except (socket.timeout, RPCBusy) as e:
+                    print("Failed to get stats of node %s: %r" % (args[0], e))
+                    continue
+            else:
+                stats = node.stats()
+
+            print(format_stats(stats))
+
+        elif cmd in ['cs', 'cluster_stats']:
+            "Print stats of every node that can be found, one row per node"
+
+            try:
+                cluster = await node.cluster_stats()
+            except (socket.timeout, RPCBusy) as e:
+                print("Failed to get cluster stats: %r" % e)
+                continue
+
+            print(format_cluster_stats(cluster))
+
+        elif cmd in ['prof', 'profile']:
+            "Profile a node (mine by default): prof cpu_start|cpu_stop|mem_start|mem_snapshot|mem_stop|lag_start|lag_stop [host]"
+
+            if len(args) not in (1, 2):
+                print("Expected 1 or 2 arguments, %d given" % len(args))
+            elif len(args) == 2:
+                try:
+                    print(await node.profile(get_sock_from_name(args[1]), node.identifier, args[0]))
+                except (socket.timeout, RPCBusy) as e:
+                    print("Failed to reach node %s: %r" % (args[1], e))
+            else:
+                print(node.profiler.command(args[0]))
+
         elif cmd in ['put']:
             "Store a (key, value) pair on the network DHT"
 
@@ -106,9 +147,11 @@ async def node_repl(node):
         elif cmd in ['?', 'help']:
             "List commands"
 
+            help_dict = generate_help_dict()
+
             # Find left-justification factor
-            ljust = max(map(len, HELP_DICT.keys()))
-            for cmd, doc in HELP_DICT.items():
+            ljust = max(map(len, help_dict.keys()))
+            for cmd, doc in help_dict.items():
                 print(cmd.ljust(ljust) + " : " + doc)
 
             print()
@@ -137,15 +180,21 @@ def start_node_with_repl(sock_addr):
     # On receiving SIGINT Ctrl+C it will try to stop the loop
     loop.add_signal_handler(signal.SIGINT, loop.stop)
 
-    f = loop.create_datagram_endpoint(Node, local_addr=sock_addr)
+    # Loading my identity is much cheaper than generating a key pair
+    identity = keystore.load_or_create(keystore.key_path(sock_addr))
+
+    f = loop.create_datagram_endpoint(partial(Node, identity=identity), local_addr=sock_addr)
     _, node = loop.run_until_complete(f)
     setup_logging("cli", to_file=True)
     print("MyId :", node.identifier)
 
     node.socket_addr = node.transport.get_extra_info('sockname')
 
-    loop.run_until_complete(node.store(node.socket_addr, node.identifier, node.identifier, (node.socket_addr, node.pub_key)))  # store my pub_key in my dht
+    node.storage.set(node.identifier, (node.socket_addr, node.pub_key), owned=True)  # store my pub_key in my dht
     loop.create_task(two_phase_protocol(node))
+    loop.create_task(maintain_routing_table(node))
+    loop.create_task(maintain_storage(node))
+    loop.create_task(compact_ledger(node))
     loop.create_task(node_repl(node))
     loop.run_forever()
 
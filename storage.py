@@ -0,0 +1,207 @@
+import pickle
+
+from collections import OrderedDict
+
+
+class Entry(object):
+
+    __slots__ = ('value', 'size', 'expires_at', 'republished_at', 'owned')
+
+    def __init__(self, value, size, expires_at, republished_at, owned):
+        self.value = value
+        self.size = size
+        self.expires_at = expires_at
+        self.republished_at = republished_at
+        self.owned = owned
+
+
+class Storage(object):
+
+    """
+    The key-value store backing a node's share of the DHT.
+
+    Every value has an expiry time (owned values, that this node published
+    itself, may live forever) and the total size of replicas is bounded.
+    """
+
+    def __init__(self, clock, max_bytes=None):
+
+        # callable: returns the current time in seconds
+        self.clock = clock
+
+        self.max_bytes = max_bytes
+
+        # key => Entry, least recently used first
+        self.entries = OrderedDict()
+
+        # Total (pickled) size of all values
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+    def __contains__(self, key):
+        return self.live_entry(key) is not None
+
+    def __getitem__(self, key):
+        entry = self.live_entry(key)
+
+        if entry is None:
+            self.misses += 1
+            raise KeyError(key)
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+
+        return entry.value
+
+    def __len__(self):
+        return len(self.entries)
+
+    def items(self):
+        for key in list(self.entries):
+            entry = self.live_entry(key)
+            if entry is not None:
+                yield key, entry.value
+
+    def live_entry(self, key):
+        entry = self.entries.get(key)
+
+        if entry is not None and entry.expires_at is not None and entry.expires_at <= self.clock():
+            self.remove(key)
+            self.expired += 1
+            return None
+
+        return entry
+
+    def set(self, key, value, ttl=None, owned=False):
+        """
+        Store a value that expires in ttl seconds (or never if ttl is None.)
+        """
+
+        now = self.clock()
+        previous = self.entries.get(key)
+
+        if previous is not None:
+            # Someone else republishing our value doesn't make it theirs,
+            # and doesn't get to (shorten its expiry or) replace it either.
+            # We republish it ourselves.
+            if previous.owned and not owned:
+                return
+
+            self.remove(key)
+
+        entry = Entry(
+            value=value,
+            size=len(pickle.dumps(value)),
+            expires_at=None if ttl is None else now + ttl,
+            republished_at=now,
+            owned=owned,
+        )
+
+        self.entries[key] = entry
+        self.bytes += entry.size
+
+        self.evict()
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def ttl(self, key):
+        """
+        Seconds left before key expires (None if it never does.)
+        """
+
+        entry = self.entries[key]
+
+        if entry.expires_at is None:
+            return None
+
+        return max(0, entry.expires_at - self.clock())
+
+    def evict(self):
+        """
+        Drop least recently used replicas until we're within max_bytes.
+        """
+
+        if self.max_bytes is None or self.bytes <= self.max_bytes:
+            return
+
+        for key in list(self.entries):
+            if self.bytes <= self.max_bytes:
+                break
+
+            if not self.entries[key].owned:
+                self.remove(key)
+                self.evicted += 1
+
+    def expire(self):
+        """
+        Drop all expired values, returns how many were dropped.
+        """
+
+        now = self.clock()
+        expired = [
+            key for key, entry in self.entries.items()
+            if entry.expires_at is not None and entry.expires_at <= now
+        ]
+
+        for key in expired:
+            self.remove(key)
+
+        self.expired += len(expired)
+        return len(expired)
+
+    def due_for_republish(self, interval):
+        """
+        Keys that haven't been (re)stored for atleast interval seconds.
+
+        A replica that someone else recently pushed to us doesn't need to be
+        republished by us, since the other k-1 holders have it too.
+        """
+
+        now = self.clock()
+
+        return [
+            key for key, entry in self.entries.items()
+            if now - entry.republished_at >= interval
+        ]
+
+    def mark_republished(self, key):
+        if key in self.entries:
+            self.entries[key].republished_at = self.clock()
+
+    def is_owned(self, key):
+        return key in self.entries and self.entries[key].owned
+
+    def snapshot(self):
+        """
+        A picklable list of (key, value, ttl, owned) tuples.
+        """
+
+        return [
+            (key, entry.value, self.ttl(key), entry.owned)
+            for key, entry in self.entries.items()
+        ]
+
+    def restore(self, snapshot):
+        for key, value, ttl, owned in snapshot:
+            if ttl is None or ttl > 0:
+                self.set(key, value, ttl=ttl, owned=owned)
+
+    def stats(self):
+        return {
+            'keys': len(self.entries),
+            'owned': sum(1 for entry in self.entries.values() if entry.owned),
+            'bytes': self.bytes,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'expired': self.expired,
+            'evicted': self.evicted,
+        }
@@ -0,0 +1,98 @@
+"""
+Helpers that keep logging cheap on the message hot path.
+
+Per message logs go through a MessageLog, which checks the level before
+doing anything else, only lets through a sample of the messages, and
+truncates the payloads it does log. Payloads are only repr'd if the record
+is actually emitted.
+"""
+
+import logging
+import reprlib
+
+import config
+
+# Never equal to anything in a dict we're diffing
+MISSING = object()
+
+
+class ShortRepr(reprlib.Repr):
+
+    """
+    reprlib.Repr that doesn't walk a whole ledger just to truncate it.
+    """
+
+    def __init__(self, limit):
+        super(ShortRepr, self).__init__()
+
+        self.maxstring = self.maxother = limit
+        self.maxlist = self.maxtuple = self.maxdict = self.maxset = 8
+
+    def repr_Ledger(self, ledger, level):
+        return '<%s of %d transactions>' % (type(ledger).__name__, len(ledger.record))
+
+    repr_LightLedger = repr_ShardedLedger = repr_Ledger
+
+    def repr_bytes(self, data, level):
+        if len(data) <= self.maxstring:
+            return repr(data)
+
+        return '<%d bytes>' % len(data)
+
+
+short_repr = ShortRepr(config.LOG_PAYLOAD_LIMIT)
+
+
+class Short(object):
+
+    """
+    Wraps a log argument, so that it's shortened when (and if) it's formatted.
+    """
+
+    __slots__ = ('obj', )
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __repr__(self):
+        return short_repr.repr(self.obj)
+
+    __str__ = __repr__
+
+
+class MessageLog(object):
+
+    """
+    Logs atmost one in every 1 / sample_rate calls at INFO level.
+    """
+
+    def __init__(self, logger, sample_rate=config.LOG_SAMPLE_RATE):
+        self.logger = logger
+        self.every = round(1 / sample_rate) if sample_rate else 0
+        self.calls = 0
+
+    def __call__(self, msg, *args):
+        if not self.every or not self.logger.isEnabledFor(logging.INFO):
+            return
+
+        self.calls += 1
+        if self.calls % self.every:
+            return
+
+        self.logger.info(msg, *[arg if isinstance(arg, (int, float)) else Short(arg) for arg in args])
+
+
+def changes(previous, current):
+    """
+    What's different between two dicts: (added or changed items, removed keys)
+    """
+
+    updated = {key: value for key, value in current.items() if previous.get(key, MISSING) != value}
+    removed = [key for key in previous if key not in current]
+
+    return updated, removed
+
+
+def setup_levels(levels=config.LOG_LEVELS):
+    for name, level in levels.items():
+        logging.getLogger(name).setLevel(level)
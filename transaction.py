@@ -1,5 +1,29 @@
+import bisect
+import copy
+import pickle
 import time
 
+from utils import sha1_int
+
+# Transaction ids (and compaction checkpoints) are read off this clock,
+# simulations swap in their event loop's virtual time (see simnet.py)
+clock = time.time
+
+# The last id handed out, ids made within the same tick of clock
+# (say, both halves of a pair) are bumped past it
+last_id = 0
+
+
+def next_id():
+    """
+    The current time in nanoseconds, or one more than the last id.
+    """
+
+    global last_id
+
+    last_id = max(int(clock() * (10**9)), last_id + 1)
+    return last_id
+
 
 class Ledger(object):
 
@@ -17,6 +41,16 @@ class Ledger(object):
         self.genesis_tx = Transaction.genesis(receiver=node_id)
         self.record = [self.genesis_tx]
 
+        # Has genesis_tx been sent out to the network yet?
+        # (a ledger restored from a snapshot usually has)
+        self.joined = False
+
+        # Spent transactions with ids below checkpoint have been archived,
+        # only their count and (XOR of) digests are kept in memory
+        self.checkpoint = 0
+        self.archived_count = 0
+        self.archived_root = 0
+
     def __iter__(self):
         return iter(self.record)
 
@@ -29,12 +63,138 @@ class Ledger(object):
     def index(self, item):
         return self.record.index(item)
 
-    # TODO: Support adding a list of transactions (list.extend)
+    def find(self, tx_id):
+        """
+        The transaction with id tx_id (None if it isn't in the ledger.)
+        """
+
+        ids = [tx.id for tx in self.record]
+        i = bisect.bisect_left(ids, tx_id)
+
+        if i < len(ids) and ids[i] == tx_id:
+            return self.record[i]
+
+        return None
+
+    def touching(self, account):
+        """
+        Transactions that account was a sender, receiver or witness of.
+        """
+
+        return [tx for tx in self.record if tx.touches(account)]
+
+    def missing_inputs(self, txs):
+        """
+        Ids of the inputs of a transaction (pair) that aren't in the ledger.
+        """
+
+        return [tx.id for tx in txs[0].input_tx if tx not in self.record]
+
+    def spend(self, tx):
+        """
+        Mark an (input) transaction as spent, if it is in the ledger.
+
+        Returns True if it wasn't already spent.
+        """
+
+        known = self.find(getattr(tx, 'id', tx))
+
+        if known is None or known.spent:
+            return False
+
+        known.spent = True
+        return True
+
+    def unspend(self, tx_id):
+        """
+        Undo a spend() of the transaction with id tx_id.
+        """
+
+        known = self.find(tx_id)
+
+        if known is not None:
+            known.spent = False
+
+    def compact(self, checkpoint, archive_path=None, keep=()):
+        """
+        Archive spent transactions with ids below checkpoint, except the
+        ones whose ids are in keep (they're archived by a later compaction.)
+
+        They're appended to archive_path (if given) and dropped from memory.
+        The remaining transactions are replaced by copies whose input_tx
+        lists hold the ids of their inputs, so that pickling one doesn't
+        drag along its whole history. Returns the number of archived
+        transactions.
+        """
+
+        archived = [tx for tx in self.record if tx.spent and tx.id < checkpoint and tx.id not in keep]
+
+        if archive_path is not None and archived:
+            with open(archive_path, 'ab') as f:
+                pickle.dump(archived, f)
+
+        for tx in archived:
+            self.archived_root ^= tx.digest()
+
+        self.archived_count += len(archived)
+        self.checkpoint = max(self.checkpoint, checkpoint)
+
+        archived = set(tx.id for tx in archived)
+
+        # Others (a pending commit, the broadcast cache) may still hold the
+        # transactions themselves and need their inputs in full
+        self.record = [tx.flattened() for tx in self.record if tx.id not in archived]
+
+        return len(archived)
+
+    def range(self, start, end):
+        """
+        Transactions with start <= id < end.
+        """
+
+        ids = [tx.id for tx in self.record]
+        return self.record[bisect.bisect_left(ids, start):bisect.bisect_left(ids, end)]
+
+    def keeps(self, tx):
+        """
+        Does this ledger store tx (in full) when it's added?
+        """
+
+        return True
+
     def add_tx(self, tx):
         if tx not in self.record:
             self.record.append(tx)
             self.record.sort(key=lambda tx: tx.id)
 
+    def remove_tx(self, tx):
+        if tx in self.record:
+            self.record.remove(tx)
+
+    def merge(self, txs):
+        """
+        Add (in one go) the transactions in txs that this ledger keeps.
+
+        Where we both have a transaction, my copy stays (but is marked
+        spent if theirs is.) Returns the number of transactions added.
+        """
+
+        merged = {tx.id: tx for tx in self.record}
+        before = len(merged)
+
+        for tx in txs:
+            mine = merged.get(tx.id)
+
+            if mine is None:
+                if self.keeps(tx):
+                    merged[tx.id] = tx
+            elif tx.spent:
+                mine.spent = True
+
+        self.record = [merged[tx_id] for tx_id in sorted(merged)]
+
+        return len(merged) - before
+
     def gen_trans(self, sender, receiver, witness, amount):
         """
         Generate a new transaction (or a pair of them.)
@@ -75,11 +235,16 @@ class Ledger(object):
 
         return True, txs
 
-    def verify_trans(self, txs):
+    def verify_trans(self, txs, inputs=None):
         """
         Verify that a transaction (pair) is valid wrt the ledger.
+
+        Inputs that aren't in the ledger may be supplied as a dict of
+        id => transaction (as fetched from other nodes.)
         """
 
+        inputs = inputs or {}
+
         # If the tranasction is a pair - both of them should have same fields
         if(len(txs) == 1) or (len(txs) == 2 and
                               txs[0].input_tx == txs[1].input_tx and
@@ -91,13 +256,18 @@ class Ledger(object):
             # Check whether all input transactions are correctly valid
             for tx in txs[0].input_tx:
 
+                if tx in self.record:
+                    known = self.record[self.record.index(tx)]
+                else:
+                    known = inputs.get(tx.id)
+
                 if (
                     # An input may be invalid because
-                    tx not in self.record or  # It may be Unknown
+                    known is None or  # It may be Unknown
                     # It may not be owned by the sender
                     tx.receiver != txs[0].sender or
                     # It may be already spent
-                    self.record[self.record.index(tx)].spent
+                    known.spent
                 ):
                     return False
                 else:
@@ -113,13 +283,93 @@ class Ledger(object):
             return False
 
 
+class LightLedger(Ledger):
+
+    """
+    A ledger that only keeps the transactions its owner is involved in.
+
+    Other transactions are only counted (once each, by id.) Without them
+    a light node can't check inputs itself, it goes by what the majority
+    of its peers say about them (see Node.fetch_inputs.)
+    """
+
+    def __init__(self, node_id):
+        super(LightLedger, self).__init__(node_id)
+
+        # Ids of the transactions counted since the last checkpoint, the
+        # ones compact() has gone past are only counted in archived_headers
+        self.headers = set()
+        self.archived_headers = 0
+
+    def __repr__(self):
+        return "LightLedger(%d records, %d headers=[\n%s\n])" % (
+            len(self.record), self.header_count(), ",\n".join([repr(tx) for tx in self.record]))
+
+    def header_count(self):
+        return self.archived_headers + len(self.headers)
+
+    def keeps(self, tx):
+        return tx.touches(self.node_id)
+
+    def add_tx(self, tx):
+        if self.keeps(tx):
+            super(LightLedger, self).add_tx(tx)
+        elif tx.id >= self.checkpoint:
+            # (Older ones were counted before the checkpoint passed them)
+            self.headers.add(tx.id)
+
+    def compact(self, checkpoint, archive_path=None, keep=()):
+        archived = super(LightLedger, self).compact(checkpoint, archive_path, keep)
+
+        # Headers below the checkpoint won't be undone anymore, so
+        # their ids needn't be kept around (just their number)
+        done = set(tx_id for tx_id in self.headers if tx_id < self.checkpoint and tx_id not in keep)
+
+        self.headers -= done
+        self.archived_headers += len(done)
+
+        return archived
+
+    def remove_tx(self, tx):
+        super(LightLedger, self).remove_tx(tx)
+        self.headers.discard(tx.id)
+
+
+class ShardedLedger(Ledger):
+
+    """
+    A ledger that only keeps the outputs owned by accounts in its shard
+    (and the transactions its owner is involved in.)
+
+    owns(account) tells whether an account falls into this node's shard.
+    """
+
+    def __init__(self, node_id, owns):
+        super(ShardedLedger, self).__init__(node_id)
+
+        self.owns = owns
+
+    def __getstate__(self):
+        # owns is bound to the node, which can't (and needn't) be pickled
+        state = self.__dict__.copy()
+        state['owns'] = None
+        return state
+
+    def keeps(self, tx):
+        return tx.touches(self.node_id) or self.owns(tx.receiver)
+
+    def add_tx(self, tx):
+        if self.keeps(tx):
+            super(ShardedLedger, self).add_tx(tx)
+
+
 class Transaction(object):
 
     def __init__(self, sender, receiver, witness, amount, input_tx=None):
 
         # Transaction ID is time (for virtual synchrony)
         # (multiplying by 10^9 gives us nanoseconds)
-        self.id = int(time.time() * (10**9))
+        self.id = next_id()
 
         # List of input transactions (None for Genesis)
         self.input_tx = input_tx
@@ -137,9 +387,32 @@ class Transaction(object):
     def genesis(receiver, amount=100):
         return Transaction(sender=None, receiver=receiver, witness=None, amount=amount, input_tx=None)
 
+    def input_ids(self):
+        return [getattr(tx, 'id', tx) for tx in self.input_tx or []]
+
+    def flattened(self):
+        """
+        A copy of this transaction with its input transactions replaced by
+        their ids (or itself, if that's already the case.)
+        """
+
+        if all(isinstance(tx, int) for tx in self.input_tx or []):
+            return self
+
+        tx = copy.copy(self)
+        tx.input_tx = self.input_ids()
+        return tx
+
+    def touches(self, account):
+        return account in (self.sender, self.receiver, self.witness)
+
+    def digest(self):
+        return sha1_int("%d:%r:%r:%r:%d" % (self.id, self.sender, self.receiver, self.witness, self.amount))
+
     def __eq__(self, other):
         # No need to compare other attributes as the ID must be unique
-        return self.id == other.id
+        # (inputs of compacted transactions are just ids)
+        return self.id == getattr(other, 'id', other)
 
     def __add__(self, other):
         return self.amount + other.amount
@@ -188,3 +461,4 @@ if __name__ == '__main__':
 
     # Demo Ledger.__repr__
     print(l)
+
@@ -17,12 +17,29 @@ def sha1_int(key):
     return int.from_bytes(digest, byteorder='big', signed=False)
 
 
+def shard_key(account):
+    """
+    Position of an account (a node identifier) in the DHT's keyspace.
+    """
+
+    return sha1_int(account.to_bytes(20, byteorder='big', signed=False))
+
+
 def random_id():
     identifier = random.getrandbits(160)
 
     return sha1_int(identifier.to_bytes(20, byteorder='big', signed=False))
 
 
+def bounded(ordered_dict, size):
+    """
+    Drop the oldest entries of an OrderedDict until it has atmost size items.
+    """
+
+    while len(ordered_dict) > size:
+        ordered_dict.popitem(last=False)
+
+
 def gen_pub_pvt():
     """
     Generate key-pair.
@@ -0,0 +1,140 @@
+import asyncio
+import os
+import pickle
+import struct
+
+# Each record is a pickle preceded by its length
+RECORD_HEADER = struct.Struct('!I')
+
+
+class WriteAheadLog(object):
+
+    """
+    An append only log of pickled records, fsync'd before they're acknowledged.
+
+    Records appended within delay seconds of each other are written (and
+    fsync'd) together, so that durability doesn't cost one fsync per record.
+    """
+
+    def __init__(self, path, delay=0):
+
+        self.path = path
+        self.delay = delay
+
+        # Records that survived our last run, a torn write at the
+        # end (if we crashed in the middle of one) is cut off
+        self.recovered, end = read_records(path)
+
+        self.file = open(path, 'ab')
+        self.file.truncate(end)
+
+        # (data, future) waiting to be written
+        self.pending = []
+
+        # Is a flush scheduled or running?
+        self.flushing = False
+
+        self.fsyncs = 0
+
+    def append(self, record):
+        """
+        Log a record, returns a future that's done once it is on disk.
+        """
+
+        data = pickle.dumps(record)
+        future = asyncio.Future()
+
+        self.pending.append((RECORD_HEADER.pack(len(data)) + data, future))
+
+        if not self.flushing:
+            self.flushing = True
+            asyncio.get_event_loop().call_later(self.delay, lambda: asyncio.ensure_future(self.flush()))
+
+        return future
+
+    @asyncio.coroutine
+    def flush(self):
+        loop = asyncio.get_event_loop()
+
+        # Whatever piles up while we're writing goes into the next batch
+        while self.pending:
+            group, self.pending = self.pending, []
+
+            try:
+                yield from loop.run_in_executor(None, self.write, b''.join(data for data, _ in group))
+            except OSError as e:
+                for _, future in group:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for _, future in group:
+                    if not future.done():
+                        future.set_result(None)
+
+        self.flushing = False
+
+    def write(self, data):
+        self.file.write(data)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+        self.fsyncs += 1
+
+    def truncate(self):
+        """
+        Drop all records (once they're part of a snapshot.)
+
+        Returns False, without doing anything, while a write is in progress.
+        """
+
+        if self.flushing:
+            return False
+
+        self.file.truncate(0)
+        self.recovered = []
+
+        return True
+
+    def close(self):
+        """
+        Close the log, and remove it if it's empty (say, truncated after a
+        snapshot) so that logs of identities that don't come back (see
+        keystore.py) don't pile up.
+        """
+
+        empty = os.fstat(self.file.fileno()).st_size == 0
+        self.file.close()
+
+        if empty:
+            os.remove(self.path)
+
+
+def read_records(path):
+    """
+    All complete records in the log at path, and the offset at which they end.
+    """
+
+    if not os.path.exists(path):
+        return [], 0
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    records = []
+    offset = 0
+
+    while offset + RECORD_HEADER.size <= len(data):
+        size, = RECORD_HEADER.unpack_from(data, offset)
+        start = offset + RECORD_HEADER.size
+
+        if start + size > len(data):
+            break
+
+        try:
+            records.append(pickle.loads(data[start:start + size]))
+        except (pickle.UnpicklingError, EOFError, ValueError):
+            break
+
+        offset = start + size
+
+    return records, offset